@@ -0,0 +1,552 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:12:40 2026
+
+@author: Caasar
+"""
+
+import os
+import re
+import struct
+import hashlib
+import shutil
+import threading
+from collections import OrderedDict
+import PIL.Image as Image
+from wrapper.base import CacheIndex, atomic_write
+
+
+class PageCache(object):
+    """
+    A thread safe LRU cache for decoded and scaled pages.
+
+    Pages are stored under the key ``(path, filename, sizekey)``, where
+    ``sizekey`` is derived from the original size of the page, e.g. the
+    target size it was scaled to. The least recently used pages are dropped
+    as soon as the stored images need more than ``maxbytes``.
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # the original size and the number of entries of each page
+        self._origsizes = dict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, path, filename, sizekey):
+        """
+        Return the cached data of the page or None.
+
+        Parameters
+        ----------
+        path : str
+            The path of the wrapper containing the page.
+        filename : str
+            The filename of the page inside the wrapper.
+        sizekey : callable
+            Called with the original size of the page and returns the size
+            dependent part of the key.
+        """
+        with self._lock:
+            sizes = self._origsizes.get((path, filename))
+            if sizes is not None:
+                key = path, filename, sizekey(sizes[0])
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key][0]
+            self.misses += 1
+            return None
+
+    def put(self, path, filename, sizekey, data):
+        """
+        Store the data of a page. ``data`` is a dict containing at least
+        the scaled image as ``img`` and the size of the original as
+        ``origsize``.
+        """
+        origsize = tuple(data['origsize'])
+        nbytes = self.image_bytes(data['img'])
+        with self._lock:
+            key = path, filename, sizekey(origsize)
+            if key in self._entries:
+                self._pop(key)
+            if nbytes > self.maxbytes:
+                return
+            self._entries[key] = data, nbytes
+            self._nbytes += nbytes
+            sizes = self._origsizes.setdefault((path, filename), [origsize, 0])
+            sizes[0] = origsize
+            sizes[1] += 1
+            self._shrink()
+
+    def resize(self, maxbytes):
+        with self._lock:
+            self.maxbytes = maxbytes
+            self._shrink()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._origsizes.clear()
+            self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    @staticmethod
+    def image_bytes(img):
+        width, height = img.size
+        return width * height * len(img.getbands())
+
+    def _pop(self, key):
+        dummy, nbytes = self._entries.pop(key)
+        self._nbytes -= nbytes
+        # forget the original size with the last entry of the page
+        sizes = self._origsizes[key[:2]]
+        sizes[1] -= 1
+        if sizes[1] == 0:
+            del self._origsizes[key[:2]]
+
+    def _shrink(self):
+        while self._nbytes > self.maxbytes:
+            self._pop(next(iter(self._entries)))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class BatchWriter(object):
+    """
+    Writes queued items in batches from a background thread.
+
+    Items are queued under a key by ``put`` and handed to ``write`` as list
+    of key and item pairs after a short delay. An item queued again before
+    it was written replaces the queued one. ``put`` blocks while two
+    batches are waiting, so the queue can not grow without bounds.
+    """
+    def __init__(self, write, batch=64, delay=.5):
+        self.write = write
+        self.batch = batch
+        self.delay = delay
+        self._pending = OrderedDict()
+        self._busy = False
+        self._flushing = 0
+        self._closed = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def put(self, key, item):
+        with self._cond:
+            self._cond.wait_for(lambda: key in self._pending or
+                                len(self._pending) < 2*self.batch)
+            self._pending[key] = item
+            if self._thread is None or not self._thread.is_alive():
+                self._closed = False
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def get(self, key):
+        """
+        Return the item queued under key or None if it is not queued.
+        """
+        with self._cond:
+            return self._pending.get(key)
+
+    def flush(self):
+        """
+        Block until all queued items are written.
+        """
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                self._cond.wait_for(lambda: not self._pending and
+                                            not self._busy)
+            finally:
+                self._flushing -= 1
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    return
+                # give the following items the chance to join the batch
+                self._cond.wait_for(lambda: len(self._pending) >= self.batch
+                                    or self._flushing or self._closed,
+                                    self.delay)
+                items = []
+                while self._pending and len(items) < self.batch:
+                    items.append(self._pending.popitem(last=False))
+                self._busy = True
+                self._cond.notify_all()
+            try:
+                self.write(items)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+
+class DiskCache(object):
+    """
+    Stores scaled pages as JPEG files inside a cache folder.
+
+    Every page gets its own subfolder, named after a hash of the path and
+    modification time of its archive and its filename. The file in that
+    folder is named after the original and the scaled size of the page, so
+    a changed archive or changed scaling settings never return stale pages.
+    Only the last stored size of a page is kept.
+
+    The pages are encoded and written in a background thread. Other data
+    of an archive, like the image index of a PDF file, is stored by
+    ``put_file`` in the same way under a name instead of a page. The least
+    recently used entries are removed once the folder holds more than
+    ``maxbytes``.
+    """
+    quality = 90
+    maxbytes = 2**31
+    data_name = 'data.bin'
+    re_name = re.compile(r'^(\d+)x(\d+)_(\d+)x(\d+)\.jpg$')
+    re_digest = re.compile(r'^[0-9a-f]{40}$')
+
+    def __init__(self, folder=''):
+        self.folder = ''
+        self._index = CacheIndex(self._scan, self._remove, self.maxbytes)
+        # the queued pages are kept in memory, so only allow a few of them
+        self._writer = BatchWriter(self._write, batch=8)
+        self.set_folder(folder)
+
+    def set_folder(self, folder):
+        self.folder = folder if folder and os.path.isdir(folder) else ''
+        self._index.set_folder(self.folder)
+
+    def get(self, path, filename, sizekey):
+        """
+        Return the cached page as dict with the scaled image as ``img`` and
+        the size of the original as ``origsize`` or None if the page is not
+        in the cache. ``sizekey`` is called with the original size and
+        returns the scaled size.
+        """
+        entry = self._entry_folder(path, filename)
+        if entry is None:
+            return None
+        data = self._writer.get(entry)
+        if data is not None:
+            if tuple(sizekey(data['origsize'])) == data['img'].size:
+                return data
+            return None
+        try:
+            names = os.listdir(entry)
+        except OSError:
+            return None
+
+        for name in names:
+            match = self.re_name.match(name)
+            if match is None:
+                continue
+            ow, oh, w, h = (int(v) for v in match.groups())
+            if tuple(sizekey((ow, oh))) == (w, h):
+                fullpath = os.path.join(entry, name)
+                try:
+                    img = Image.open(fullpath)
+                    img.load()
+                    # the modification time marks the last use
+                    os.utime(fullpath)
+                except OSError:
+                    return None
+                self._index.touch(entry)
+                return {'img': img.convert('RGB'), 'origsize': (ow, oh)}
+        return None
+
+    def put(self, path, filename, data):
+        """
+        Queue the scaled image ``data['img']`` of the page with the original
+        size ``data['origsize']`` to be stored.
+        """
+        entry = self._entry_folder(path, filename)
+        if entry is not None:
+            self._writer.put(entry, data)
+
+    def get_file(self, path, name):
+        """
+        Return the content stored as name for the archive at path or None.
+        """
+        entry = self._entry_folder(path, name)
+        if entry is None:
+            return None
+        fullpath = os.path.join(entry, self.data_name)
+        try:
+            with open(fullpath, 'rb') as fin:
+                content = fin.read()
+            os.utime(fullpath)
+        except OSError:
+            return None
+        self._index.touch(entry)
+        return content
+
+    def put_file(self, path, name, content):
+        """
+        Store the bytes content as name for the archive at path.
+        """
+        entry = self._entry_folder(path, name)
+        if entry is None:
+            return
+        try:
+            os.makedirs(entry, exist_ok=True)
+            with atomic_write(os.path.join(entry, self.data_name)) as fout:
+                fout.write(content)
+        except OSError:
+            return
+        self._index.add(entry, len(content))
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+
+    def _write(self, items):
+        for entry, data in items:
+            img = data['img']
+            ow, oh = data['origsize']
+            name = f'{ow}x{oh}_{img.size[0]}x{img.size[1]}.jpg'
+            try:
+                os.makedirs(entry, exist_ok=True)
+                with atomic_write(os.path.join(entry, name)) as fout:
+                    img.save(fout, 'jpeg', quality=self.quality)
+                # drop the page scaled to other sizes
+                for old in os.listdir(entry):
+                    if old != name and self.re_name.match(old):
+                        os.remove(os.path.join(entry, old))
+                nbytes = os.path.getsize(os.path.join(entry, name))
+            except OSError:
+                continue
+            self._index.add(entry, nbytes)
+
+    @classmethod
+    def _scan(cls, folder):
+        """
+        Yield the modification time, the folder and the size of all cached
+        entries.
+        """
+        try:
+            groups = [e.path for e in os.scandir(folder)
+                      if len(e.name) == 2 and e.is_dir()]
+        except OSError:
+            return
+        for group in groups:
+            try:
+                entries = [e.path for e in os.scandir(group)
+                           if cls.re_digest.match(e.name) and e.is_dir()]
+            except OSError:
+                continue
+            for entry in entries:
+                mtime, nbytes = 0, 0
+                try:
+                    for cur in os.scandir(entry):
+                        if cls.re_name.match(cur.name) or \
+                          cur.name == cls.data_name:
+                            stat = cur.stat()
+                            mtime = max(mtime, stat.st_mtime)
+                            nbytes += stat.st_size
+                except OSError:
+                    continue
+                yield mtime, entry, nbytes
+
+    @staticmethod
+    def _remove(entry):
+        shutil.rmtree(entry, ignore_errors=True)
+
+    def _entry_folder(self, path, filename):
+        if not self.folder:
+            return None
+        # files inside a folder are tracked by their own modification time
+        fullpath = path
+        if os.path.isdir(path):
+            fullpath = os.path.join(path, filename)
+        try:
+            mtime = os.stat(fullpath).st_mtime_ns
+        except (OSError, ValueError):
+            return None
+        key = f'{os.path.abspath(path)}\n{mtime}\n{filename}'
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, digest[:2], digest)
+
+
+class WebCache(object):
+    """
+    Stores downloaded images in the webcache folder, so they do not have to
+    be downloaded again.
+
+    Images are queued by ``put`` and written in batches by a background
+    thread. An image queued again before it is written replaces the queued
+    one, so it is only written once. Putting an image which is already
+    stored replaces it. ``get`` returns stored and queued images.
+
+    If ``pack`` is set, all images of a wrapper are appended to the single
+    file ``<name>.pack`` instead of the folder ``<name>``. Each record of a
+    pack consists of the length of the filename and the data, the filename
+    and the data. A replaced image is appended again and the newest record
+    of a filename is used.
+
+    The webcache keeps every image of the comics read, so neither the image
+    folders nor the packs are limited in size or evicted. Only the cached
+    responses of the HttpCache in its ``.http`` folder have a size cap.
+    """
+    pack_header = struct.Struct('<HI')
+
+    def __init__(self, folder='', pack=False):
+        self.folder = ''
+        self.pack = False
+        # the index of every pack file, see _pack_index
+        self._packs = dict()
+        self._lock = threading.Lock()
+        self._writer = BatchWriter(self._write)
+        self.set_folder(folder, pack)
+
+    def set_folder(self, folder, pack=False):
+        self.folder = folder if folder and os.path.isdir(folder) else ''
+        self.pack = bool(pack)
+
+    def put(self, name, filename, data):
+        """
+        Queue the image data to be stored as filename for the wrapper name.
+        """
+        if not self.folder:
+            return
+        self._writer.put((self.folder, self.pack, name, filename), data)
+
+    def get(self, name, filename):
+        """
+        Return the data of the image stored as filename for the wrapper name
+        or None.
+        """
+        if not self.folder:
+            return None
+        data = self._writer.get((self.folder, self.pack, name, filename))
+        if data is not None:
+            return data
+        try:
+            with open(os.path.join(self.folder, name, filename), 'rb') as fin:
+                return fin.read()
+        except OSError:
+            pass
+
+        path = os.path.join(self.folder, name + '.pack')
+        entry = self._pack_index(path).get(filename)
+        if entry is None:
+            return None
+        offset, size = entry
+        try:
+            with open(path, 'rb') as fin:
+                fin.seek(offset)
+                return fin.read(size)
+        except OSError:
+            return None
+
+    def flush(self):
+        """
+        Block until all queued images are written.
+        """
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+
+    def _write(self, items):
+        packs = OrderedDict()
+        for (folder, pack, name, filename), data in items:
+            if pack:
+                path = os.path.join(folder, name + '.pack')
+                packs.setdefault(path, []).append((filename, data))
+                continue
+            path = os.path.join(folder, name, filename)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with atomic_write(path) as fout:
+                    fout.write(data)
+            except OSError:
+                pass
+
+        for path, entries in packs.items():
+            try:
+                self._append_pack(path, entries)
+            except OSError:
+                with self._lock:
+                    self._packs.pop(path, None)
+
+    def _pack_index(self, path):
+        """
+        Return the index of the pack file at path, which maps the filenames
+        to the offset and the size of their data.
+        """
+        with self._lock:
+            index = self._packs.get(path)
+            if index is None:
+                index = dict()
+                try:
+                    with open(path, 'rb') as fin:
+                        for filename, offset, size in self.pack_entries(fin):
+                            index[filename] = offset, size
+                except OSError:
+                    pass
+                self._packs[path] = index
+            return index
+
+    def _append_pack(self, path, entries):
+        index = self._pack_index(path)
+        end = max((offset + size for offset, size in index.values()),
+                  default=0)
+        offset = end
+        added = dict()
+        records = []
+        for filename, data in entries:
+            # a newer record of filename replaces the older ones
+            encoded = filename.encode('utf-8')
+            records.append(self.pack_header.pack(len(encoded), len(data)))
+            records.append(encoded)
+            records.append(data)
+            start = offset + self.pack_header.size + len(encoded)
+            added[filename] = start, len(data)
+            offset = start + len(data)
+
+        with open(path, 'ab') as fout:
+            # drop a record which was only partially written
+            fout.truncate(end)
+            fout.write(b''.join(records))
+        with self._lock:
+            index.update(added)
+
+    @classmethod
+    def pack_entries(cls, fin):
+        """
+        Yield the filename, offset and size of the complete records in the
+        pack file fin.
+        """
+        fin.seek(0, os.SEEK_END)
+        total = fin.tell()
+        offset = 0
+        while offset + cls.pack_header.size <= total:
+            fin.seek(offset)
+            nlen, size = cls.pack_header.unpack(fin.read(cls.pack_header.size))
+            start = offset + cls.pack_header.size + nlen
+            if start + size > total:
+                break
+            filename = fin.read(nlen).decode('utf-8')
+            yield filename, start, size
+            offset = start + size
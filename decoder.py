@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:31:05 2026
+
+@author: Caasar
+"""
+
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+import PIL.Image as Image
+from movers import segment_image
+
+
+def fit_image(img, csize):
+    """
+    Scale the image to the size csize and convert it to RGB. The image should
+    not be loaded yet, so the decoder can skip resolution which is not needed.
+    """
+    origsize = img.size
+    if csize == origsize:
+        img = img.convert('RGB')
+    elif csize[0] > .5*origsize[0]:
+        img = img.convert('RGB').resize(csize,Image.LANCZOS)
+    else:
+        # decode JPEGs at a reduced resolution using DCT scaling and
+        # only resample the remaining factor
+        img.draft('RGB', csize)
+        img = img.convert('RGB').resize(csize,Image.LANCZOS,
+                                        reducing_gap=3.0)
+
+    return img
+
+
+def decode_page(raw, csize, shm_name, segment=None):
+    """
+    Decode the encoded image raw, scale it to csize and write the RGB data
+    into the shared memory block shm_name. Runs in the worker processes.
+
+    Returns the tops and bottoms of the segments if the segmentation
+    parameters are given.
+    """
+    img = fit_image(Image.open(BytesIO(raw)), csize)
+    data = img.tobytes()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        shm.buf[:len(data)] = data
+    finally:
+        shm.close()
+
+    if segment is None:
+        return [], []
+    return segment_image(img, *segment)
+
+
+class ProcessDecoder(object):
+    """
+    Decodes and scales pages in a pool of worker processes.
+
+    Only the encoded page is sent to the worker. The scaled RGB data is
+    returned through a shared memory block which is owned by the calling
+    process. The workers are spawned instead of forked, because the viewer
+    runs several threads which must not be copied into the children.
+    """
+    def __init__(self, processes=None):
+        context = multiprocessing.get_context('spawn')
+        self._executor = ProcessPoolExecutor(processes, mp_context=context)
+
+    def decode(self, raw, csize, segment=None):
+        """
+        Return the image of size csize decoded from raw and the tops and
+        bottoms of its segments. Blocks until the worker is done.
+        """
+        nbytes = csize[0] * csize[1] * 3
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        try:
+            future = self._executor.submit(decode_page, raw, csize,
+                                           shm.name, segment)
+            tops, bottoms = future.result()
+            img = Image.frombytes('RGB', csize, shm.buf[:nbytes])
+        finally:
+            shm.close()
+            shm.unlink()
+
+        return img, tops, bottoms
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -12,20 +12,24 @@ except ImportError:
 
 import os,re,html
 import math
+from bisect import bisect_left, bisect_right
+import time
 import traceback
 from ast import literal_eval
 from six import text_type, itervalues, iteritems, reraise
 from six.moves import range
 from functools import partial
 from collections import namedtuple
+from types import MappingProxyType
 from wrapper import KNOWN_ARCHIVES, WrapperIOError
 from wrapper.archive import ArchiveWrapper
 from wrapper.pdf import PdfWrapper
-from wrapper.web import WebWrapper
-from movers import known_movers
+from wrapper.web import WebWrapper, HTTP_CACHE
+from movers import known_movers, SegmentIndex
+from cache import PageCache, DiskCache, WebCache
+from decoder import ProcessDecoder, fit_image
 from pathlib import Path
 import PIL.Image as Image
-import PIL.ImageQt as ImageQt
 
 
 def open_wrapper(path):
@@ -137,14 +141,15 @@ class WebProfileSettings(QtWidgets.QDialog):
 
 class Settings(QtWidgets.QDialog):
     settings = {'shorttimeout':1000,'longtimeout':2000, 'requiredoverlap':50,
-                'preload':5,'buffernumber':10,
+                'preload':5,'buffernumber':10, 'cachesize':512,
                 'bgcolor': QtGui.QColor(QtCore.Qt.white),
-                'saveposition':0,'overlap':20,'maxscale':200,
+                'saveposition':0,'multiprocess':0,'pdfrender':0,'webpack':0,
+                'overlap':20,'maxscale':200,
                 'minscale':20, 'write_quality': 80, 'write_optimize':1,
                 'write_progressive':1,
                 'merge_threshold':50,
                 'scaling':'1000x1600=>0x1600\n1000x2200=>900x0',
-                'webcache': ''}
+                'webcache': '', 'pagecache': ''}
     Tuple = namedtuple('Settings', settings.keys())
     settings = Tuple(**settings)
 
@@ -157,6 +162,7 @@ class Settings(QtWidgets.QDialog):
         self.mergethreshold = QtWidgets.QLineEdit(self)
         self.preload = QtWidgets.QLineEdit(self)
         self.buffernumber = QtWidgets.QLineEdit(self)
+        self.cachesize = QtWidgets.QLineEdit(self)
         self.scaling = QtWidgets.QTextEdit(self)
         self.maxscale = QtWidgets.QLineEdit(self)
         self.minscale = QtWidgets.QLineEdit(self)
@@ -165,11 +171,18 @@ class Settings(QtWidgets.QDialog):
         self.requiredoverlap = QtWidgets.QLineEdit(self)
         self.overlap = QtWidgets.QLineEdit(self)
         self.saveposition = QtWidgets.QCheckBox(self.tr("S&ave Position"),self)
+        self.multiprocess = QtWidgets.QCheckBox(self.tr("&Decode in Processes"),
+                                                self)
+        self.pdfrender = QtWidgets.QCheckBox(self.tr("&Render PDF Pages"),
+                                             self)
+        self.webpack = QtWidgets.QCheckBox(self.tr("&Pack Web Cache"), self)
         self.webcache = QtWidgets.QLineEdit(self)
+        self.pagecache = QtWidgets.QLineEdit(self)
 
         self.mergethreshold.setValidator(QtGui.QIntValidator())
         self.preload.setValidator(QtGui.QIntValidator())
         self.buffernumber.setValidator(QtGui.QIntValidator())
+        self.cachesize.setValidator(QtGui.QIntValidator())
         self.shorttimeout.setValidator(QtGui.QIntValidator())
         self.longtimeout.setValidator(QtGui.QIntValidator())
         self.maxscale.setValidator(QtGui.QIntValidator())
@@ -183,6 +196,8 @@ class Settings(QtWidgets.QDialog):
              "current one will be loaded in the background."))
         self.buffernumber.setToolTip(self.tr("Defines how many images will be "\
              "held in memory for a faster display.\nShould be larger than preload."))
+        self.cachesize.setToolTip(self.tr("Defines how many megabytes of "\
+             "scaled images are kept to reload pages without decoding them."))
         self.shorttimeout.setToolTip(self.tr("Number of miliseconds the "\
              "status display appears after a page change."))
         self.longtimeout.setToolTip(self.tr("Number of miliseconds the status "\
@@ -198,9 +213,25 @@ class Settings(QtWidgets.QDialog):
              "part is visible after advancing to the next one."))
         self.saveposition.setToolTip(self.tr("Save the position in the archive"\
              " on exit and loads it at the next start"))
+        self.multiprocess.setToolTip(self.tr("Decode and scale the images in "\
+             "separate processes to use all cores of the system."))
+        self.pdfrender.setToolTip(self.tr("Rasterize the pages of PDF files "\
+             "at the displayed size instead of extracting the embedded "\
+             "images. Applies to PDF files opened afterwards."))
+        self.webpack.setToolTip(self.tr("Append the downloaded images of "\
+             "each web comic to a single pack file in the web cache instead "\
+             "of storing every image in its own file."))
         self.webcache.setToolTip(self.tr("The folder into which all downloaded "
-             "images will be stored. If the path is empty or does not exist "
-             "the downloaded images will not be stored on the hard drive."))
+             "images will be stored. Downloaded pages are also cached there "
+             "to avoid loading them again. The stored images and pack files "
+             "are never removed automatically. If the path is empty or does "
+             "not exist the downloaded images will not be stored on the hard "
+             "drive."))
+        self.pagecache.setToolTip(self.tr("The folder into which scaled pages "
+             "of archives and the image index of PDF files are stored to speed "
+             "up reopening them. The least recently used pages are removed "
+             "once the cache grows too large. If the path is empty or does "
+             "not exist nothing will be stored."))
 
         self.cancelbuttom = QtWidgets.QPushButton(self.tr("Cancel"), self)
         self.cancelbuttom.clicked.connect(self.reject)
@@ -210,8 +241,13 @@ class Settings(QtWidgets.QDialog):
         self.bgcolor_btm.clicked.connect(self.select_color)
         self.webcache_btm = QtWidgets.QPushButton('Web Cache', self)
         self.webcache_btm.clicked.connect(self.select_webcache)
+        self.pagecache_btm = QtWidgets.QPushButton('Page Cache', self)
+        self.pagecache_btm.clicked.connect(self.select_pagecache)
 
-        self.setTabOrder(self.saveposition,self.scaling)
+        self.setTabOrder(self.saveposition,self.multiprocess)
+        self.setTabOrder(self.multiprocess,self.pdfrender)
+        self.setTabOrder(self.pdfrender,self.webpack)
+        self.setTabOrder(self.webpack,self.scaling)
         self.setTabOrder(self.scaling,self.minscale)
         self.setTabOrder(self.minscale,self.maxscale)
         self.setTabOrder(self.maxscale,self.mergethreshold)
@@ -219,12 +255,15 @@ class Settings(QtWidgets.QDialog):
         self.setTabOrder(self.overlap,self.requiredoverlap)
         self.setTabOrder(self.requiredoverlap,self.preload)
         self.setTabOrder(self.preload,self.buffernumber)
-        self.setTabOrder(self.buffernumber,self.shorttimeout)
+        self.setTabOrder(self.buffernumber,self.cachesize)
+        self.setTabOrder(self.cachesize,self.shorttimeout)
         self.setTabOrder(self.shorttimeout,self.longtimeout)
         self.setTabOrder(self.longtimeout,self.bgcolor_btm)
         self.setTabOrder(self.bgcolor_btm,self.webcache_btm)
         self.setTabOrder(self.webcache_btm,self.webcache)
-        self.setTabOrder(self.webcache,self.okbuttom)
+        self.setTabOrder(self.webcache,self.pagecache_btm)
+        self.setTabOrder(self.pagecache_btm,self.pagecache)
+        self.setTabOrder(self.pagecache,self.okbuttom)
         self.setTabOrder(self.okbuttom,self.cancelbuttom)
 
         hbox = QtWidgets.QHBoxLayout()
@@ -234,6 +273,9 @@ class Settings(QtWidgets.QDialog):
 
         layout = QtWidgets.QFormLayout()
         layout.addRow(self.saveposition)
+        layout.addRow(self.multiprocess)
+        layout.addRow(self.pdfrender)
+        layout.addRow(self.webpack)
         layout.addRow(self.tr("Scalin&g:"),self.scaling)
         layout.addRow(self.tr("M&in. Scale (%):"),self.minscale)
         layout.addRow(self.tr("M&an. Scale (%):"),self.maxscale)
@@ -242,10 +284,12 @@ class Settings(QtWidgets.QDialog):
         layout.addRow(self.tr("&Optimzed Overlap (%):"),self.requiredoverlap)
         layout.addRow(self.tr("&Preload Number:"),self.preload)
         layout.addRow(self.tr("&Buffer Number:"),self.buffernumber)
+        layout.addRow(self.tr("Cache Si&ze (MB):"),self.cachesize)
         layout.addRow(self.tr("&Short Timeout (ms):"),self.shorttimeout)
         layout.addRow(self.tr("&Long Timeout (ms):"),self.longtimeout)
         layout.addRow(self.tr("Background &Colorr:"),self.bgcolor_btm)
         layout.addRow(self.webcache_btm, self.webcache)
+        layout.addRow(self.pagecache_btm, self.pagecache)
         layout.addRow(hbox)
 
         self.setLayout(layout)
@@ -253,6 +297,7 @@ class Settings(QtWidgets.QDialog):
         self.mergethreshold.setText(text_type(settings.merge_threshold))
         self.preload.setText(text_type(settings.preload))
         self.buffernumber.setText(text_type(settings.buffernumber))
+        self.cachesize.setText(text_type(settings.cachesize))
         self.scaling.setText(text_type(settings.scaling))
         self.maxscale.setText(text_type(settings.maxscale))
         self.minscale.setText(text_type(settings.minscale))
@@ -261,8 +306,15 @@ class Settings(QtWidgets.QDialog):
         self.overlap.setText(text_type(settings.overlap))
         self.requiredoverlap.setText(text_type(settings.requiredoverlap))
         self.webcache.setText(text_type(settings.webcache))
+        self.pagecache.setText(text_type(settings.pagecache))
         if settings.saveposition:
             self.saveposition.setCheckState(QtCore.Qt.Checked)
+        if settings.multiprocess:
+            self.multiprocess.setCheckState(QtCore.Qt.Checked)
+        if settings.pdfrender:
+            self.pdfrender.setCheckState(QtCore.Qt.Checked)
+        if settings.webpack:
+            self.webpack.setCheckState(QtCore.Qt.Checked)
 
         self.bgcolor = settings.bgcolor or QtGui.QColor(QtCore.Qt.white)
         fmt = "QPushButton { background-color : rgba(%d,%d,%d,%d)}"
@@ -274,6 +326,7 @@ class Settings(QtWidgets.QDialog):
         settings['merge_threshold'] = int(self.mergethreshold.text())
         settings['preload'] = int(self.preload.text())
         settings['buffernumber'] = int(self.buffernumber.text())
+        settings['cachesize'] = int(self.cachesize.text())
         settings['scaling'] = text_type(self.scaling.toPlainText())
         settings['maxscale'] = int(self.maxscale.text())
         settings['minscale'] = int(self.minscale.text())
@@ -283,8 +336,12 @@ class Settings(QtWidgets.QDialog):
         settings['overlap'] = int(self.overlap.text())
         # convert bool to int so QSettings will not save it as a string
         settings['saveposition'] = int(self.saveposition.isChecked())
+        settings['multiprocess'] = int(self.multiprocess.isChecked())
+        settings['pdfrender'] = int(self.pdfrender.isChecked())
+        settings['webpack'] = int(self.webpack.isChecked())
         settings['bgcolor'] = self.bgcolor
         settings['webcache'] = self.webcache.text()
+        settings['pagecache'] = self.pagecache.text()
         self.settings = self.dict2tuple(settings)
         super(Settings,self).accept()
 
@@ -301,6 +358,13 @@ class Settings(QtWidgets.QDialog):
         if dialog.exec_():
             self.webcache.setText(dialog.directory().path())
 
+    def select_pagecache(self):
+        dialog = QtWidgets.QFileDialog(self)
+        dialog.setFileMode(dialog.Directory)
+        dialog.setViewMode(dialog.Detail)
+        if dialog.exec_():
+            self.pagecache.setText(dialog.directory().path())
+
     @classmethod
     def dict2tuple(cls, settings):
         cdict = cls.settings._asdict()
@@ -372,12 +436,41 @@ class PageSelect(QtWidgets.QDialog):
 
         self.value = self.slider.value()-1
 
-class WorkerThread(QtCore.QThread):
-    loaded = QtCore.Signal(int)
+class BufferImage(QtGui.QImage):
+    """
+    A RGB888 QImage over a copy of the pixel bytes of a RGB PIL image. The
+    QImage does not copy them again and keeps them alive as long as it
+    exists.
+    """
+    def __init__(self, img):
+        data = img.tobytes()
+        width, height = img.size
+        super().__init__(data, width, height, 3*width,
+                         QtGui.QImage.Format_RGB888)
+        self._data = data
+
+
+class WorkerSignals(QtCore.QObject):
+    loaded = QtCore.Signal(object)
+
+
+class PageWorker(QtCore.QRunnable):
+    """
+    Decodes a single page inside the thread pool of the ImageManager.
 
+    Workers which are no longer needed are either taken from the queue of
+    the pool or flagged as cancelled. A cancelled worker skips the decoding
+    but still emits ``loaded`` so the manager can drop its reference. A
+    worker started again after the decoding only redoes the crop.
+    """
     def __init__(self, manager, pos):
-        super().__init__(manager.viewer)
+        super().__init__()
+        # the manager keeps the reference as long as the pool might use it
+        self.setAutoDelete(False)
+        self.signals = WorkerSignals()
+        self.loaded = self.signals.loaded
         self.manager = manager
+        self.wrapper = manager.wrapper
         self.fileinfo = manager.imagelist[pos]
         self.pos = pos
         self.error = ''
@@ -385,25 +478,91 @@ class WorkerThread(QtCore.QThread):
         self.origsize = None
         self.tops = []
         self.bottoms = []
-        # necessary to remove handle in viewer
-        self.finished.connect(self.removeParent)
+        # the cropped image and its QImage prepared for the GUI thread
+        self.qimage = None
+        self.prev_img = None
+        self.display_img = None
+        self.display_tops = []
+        self.display_bottoms = []
+        self.timings = {}
+        self.started = False
+        self.cancelled = False
 
     def run(self):
+        self.started = True
+        if not self.cancelled:
+            try:
+                if self.img is None:
+                    start = time.perf_counter()
+                    data = self.manager.prepare_image(self.fileinfo, self.pos,
+                                                      self.wrapper)
+                    for k, v in data.items():
+                        setattr(self, k, v)
+                    self.timings['decode'] = time.perf_counter() - start
+                self.qimage = None
+                self.manager.prepare_display(self)
+            except WrapperIOError as err:
+                self.error = str(err)
+            except IOError as err:
+                self.error = str(err) or 'Unknown Image Loading Error'
+            except Exception:
+                self.error = traceback.format_exception(*sys.exc_info())
+
+        self.loaded.emit(self)
+
+class ArchivePrefetcher(QtCore.QRunnable):
+    """
+    Opens the archive following the current one inside the thread pool of
+    the ImageManager and decodes its first pages into the page caches, so
+    switching to the next archive does not have to wait for them.
+    """
+    def __init__(self, manager, pages):
+        super().__init__()
+        # the manager keeps the reference as long as the pool might use it
+        self.setAutoDelete(False)
+        self.signals = WorkerSignals()
+        self.loaded = self.signals.loaded
+        self.manager = manager
+        self.current = manager.wrapper
+        self.pages = pages
+        self.path = None
+        self.wrapper = None
+        self.error = ''
+        self.done = False
+        self.cancelled = False
+
+    def run(self):
+        # errors are only reported once the user opens the archive
         try:
-            data = self.manager.prepare_image(self.fileinfo, self.pos)
-            for k, v in data.items():
-                setattr(self, k, v)
-        except WrapperIOError as err:
-            self.error = str(err)
-        except IOError as err:
-            self.error = str(err) or 'Unknown Image Loading Error'
+            archlist, index = self.current.list_archives()
+            for path in archlist[index+1:]:
+                if self.cancelled:
+                    break
+                try:
+                    wrapper = open_wrapper(path)
+                except Exception:
+                    continue
+                if wrapper.filter_images():
+                    self.path = path
+                    self.wrapper = wrapper
+                    break
+                wrapper.close()
+
+            if self.wrapper is not None:
+                imagelist = self.wrapper.filter_images()
+                for pos, fileinfo in enumerate(imagelist[:self.pages]):
+                    if self.cancelled:
+                        break
+                    try:
+                        self.manager.prepare_image(fileinfo, pos, self.wrapper)
+                    except Exception:
+                        # the page is loaded again once it is shown
+                        pass
         except Exception:
             self.error = traceback.format_exception(*sys.exc_info())
+        finally:
+            self.loaded.emit(self)
 
-        self.loaded.emit(self.pos)
-
-    def removeParent(self):
-        self.setParent(None)
 
 class DroppingThread(QtCore.QThread):
     loaded_archive = QtCore.Signal()
@@ -497,6 +656,11 @@ QLabel {
             nw, nh = infos['size']
             labels.append(f'{ow} \u2715 {oh} \u21D2 {nw} \u2715 {nh}')
 
+        if 'timings' in infos:
+            timings = ', '.join(f'{k} {v*1000:.0f} ms'
+                                for k, v in infos['timings'].items())
+            labels.append(timings)
+
         if 'image_url' in infos:
             url = html.escape(infos['image_url'])
             fn = html.escape(infos['filename'])
@@ -536,12 +700,15 @@ class ImageManager(QtCore.QObject):
     DATA_ORIGSIZE = 2
     DATA_TOPS = 3
     DATA_BOTTOMS = 4
+    DATA_TIMINGS = 5
     Scaling = namedtuple('Scaling', ['ratio', 'width', 'height'])
     re_scaling = re.compile(r'(?P<iwidth>\d+)\s*x\s*(?P<iheight>\d+)\s*'\
                             r'=\>\s*(?P<width>\d+)\s*x\s*(?P<height>\d+)')
     page_changed = QtCore.Signal(int, int, str)
     info_changed = QtCore.Signal(int)
     view_changed = QtCore.Signal()
+    # time in ms to wait for running workers on shutdown
+    shutdown_timeout = 5000
 
     def __init__(self, viewer, settings):
         super().__init__()
@@ -550,9 +717,31 @@ class ImageManager(QtCore.QObject):
         self._scaling_list = []
         self.wrapper = None
         self.workers = {}
+        # workers which were cancelled while running, kept alive until
+        # they report back from the pool
+        self._cancelled = set()
+        # closed wrappers which are still read by cancelled workers
+        self._retired = []
+        self._pool = QtCore.QThreadPool(self)
+        self._pool.setMaxThreadCount(QtCore.QThread.idealThreadCount())
+        self._prefetcher = None
         self.imagelist = []
+        self._items = dict()
+        # the run of shown pages and the scene rect they cover
+        self._layout_run = None
+        self._layout_mover = None
+        self._layout_rect = QtCore.QRectF(0, 0, 0, 0)
+        # the visible pages sorted along the layout axis of the mover
+        self._span_vertical = True
+        self._span_starts = []
+        self._span_ends = []
+        self._span_pages = []
         self._images = dict()
         self._errors = dict()
+        self._segments = SegmentIndex()
+        self._cache = PageCache(settings.cachesize * 2**20)
+        self._diskcache = DiskCache()
+        self._decoder = None
         self._last_page = None
         self._booktimer = QtCore.QTimer(viewer)
         self._booktimer.timeout.connect(self._update_bookkeeping)
@@ -562,6 +751,7 @@ class ImageManager(QtCore.QObject):
         self._mover = None
         self._to_show = None
         self._use_webcache = False
+        self._webcache = WebCache()
 
         # set the first mover as the default one
         self.mover = self.movers[0]
@@ -628,6 +818,21 @@ class ImageManager(QtCore.QObject):
         self.scaling_list = sorted(scaling_list)
         self._mover.continuous = continuous
         self._mover.merge_threshold = settings.merge_threshold
+        self._cache.resize(settings.cachesize * 2**20)
+        self._diskcache.set_folder(settings.pagecache)
+        PdfWrapper.index_store = self._diskcache
+        PdfWrapper.render_pages = bool(settings.pdfrender)
+        WebWrapper.lookahead = settings.preload + 1
+        HTTP_CACHE.set_folder(settings.webcache if self._use_webcache else '')
+        self._webcache.set_folder(settings.webcache, settings.webpack)
+        WebWrapper.image_store = self._webcache if self._use_webcache else None
+        if settings.multiprocess and self._decoder is None:
+            self._decoder = ProcessDecoder()
+        elif not settings.multiprocess and self._decoder is not None:
+            self._decoder.shutdown()
+            self._decoder = None
+        if isinstance(self.wrapper, ArchiveWrapper):
+            self.wrapper.set_prefetch(settings.preload + 1)
         if refresh:
             self.refresh()
 
@@ -641,16 +846,19 @@ class ImageManager(QtCore.QObject):
         # close old wrapper if one is opened
         self.close()
         self.wrapper = wrapper
+        if isinstance(wrapper, ArchiveWrapper):
+            wrapper.set_prefetch(self.settings.preload + 1)
         self.imagelist = imagelist
         self.rectlist = [None for zi in self.imagelist]
         self._to_show = page
         self._load_page(page)
 
-    def prepare_image(self, fileinfo, pos):
+    def prepare_image(self, fileinfo, pos, wrapper=None):
         """
         Open the image referenced in fileinfo and scale it to the correct
-        size. It will also store the image to a cache path if it was downloaded
-        from the web and caching is active.
+        size. Scaled images are taken from the page caches if available. If
+        the webcache is active, web comics store their downloaded images in
+        it and read them back by their url.
 
         Parameters
         ----------
@@ -658,20 +866,77 @@ class ImageManager(QtCore.QObject):
             A fileinfo object of the currently loaded wrapper
         pos : int
             The position of the image in the image list of the current archive.
+        wrapper : BaseWrapper, optional
+            The wrapper containing the image if it is not the current one.
         """
+        if wrapper is None:
+            wrapper = self.wrapper
+        path = wrapper.path
+        data = self._cache.get(path, fileinfo.filename, self._target_size)
+        if data is None:
+            data = self._diskcache.get(path, fileinfo.filename,
+                                       self._target_size)
+            if data is not None:
+                self._cache.put(path, fileinfo.filename, self._target_size,
+                                data)
+        if data is not None:
+            img = data['img']
+            tops, bottoms = self._mover.segment_image(img)
+            return {'img': img, 'origsize': data['origsize'],
+                    'tops': tops, 'bottoms': bottoms}
 
-        with self.wrapper.open(fileinfo, 'rb') as fin:
-            if isinstance(self.wrapper, WebWrapper) and self._use_webcache:
-                filename = f'{pos + 1:03d}_{fileinfo.filename}'
-                self._store_image(filename, fin.getvalue())
-            img = Image.open(fin)
-            origsize = img.size
-            img = self._fit_image(img)
+        if isinstance(wrapper, PdfWrapper) and wrapper.render_pages:
+            img, origsize = wrapper.render(fileinfo, self._target_size)
             tops, bottoms = self._mover.segment_image(img)
+            data = {'img': img, 'origsize': origsize}
+            self._cache.put(path, fileinfo.filename, self._target_size, data)
+            self._diskcache.put(path, fileinfo.filename, data)
+            return {'img': img, 'origsize': origsize,
+                    'tops': tops, 'bottoms': bottoms}
 
+        with wrapper.open(fileinfo, 'rb') as fin:
+            img = Image.open(fin)
+            origsize = img.size
+            if self._decoder is None:
+                img = self._fit_image(img)
+                tops, bottoms = self._mover.segment_image(img)
+            else:
+                segment = None
+                if self._mover.continuous:
+                    mover = self._mover
+                    segment = mover.MaxIRange, mover.FilterLen, mover.MinRho
+                fin.seek(0)
+                csize = self._target_size(origsize)
+                img, tops, bottoms = self._decoder.decode(fin.read(), csize,
+                                                          segment)
+
+        data = {'img': img, 'origsize': origsize}
+        self._cache.put(path, fileinfo.filename, self._target_size, data)
+        self._diskcache.put(path, fileinfo.filename, data)
         return {'img': img, 'origsize': origsize,
                 'tops': tops, 'bottoms': bottoms}
 
+    def prepare_display(self, worker):
+        """
+        Crop the scaled image of the worker against the previous page and
+        wrap it into a QImage. This is done in the worker thread, so the GUI
+        thread only has to upload the pixmap.
+        """
+        start = time.perf_counter()
+        img = worker.img
+        prev_img = self.get_buffered_image(worker.pos - 1)
+        display_img = self._mover.crop_image(img, prev_img)
+        dheight = display_img.size[1] - img.size[1]
+        worker.timings['crop'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        worker.qimage = BufferImage(display_img)
+        worker.timings['qimage'] = time.perf_counter() - start
+        worker.prev_img = prev_img
+        worker.display_img = display_img
+        worker.display_tops = [t + dheight for t in worker.tops]
+        worker.display_bottoms = [t + dheight for t in worker.bottoms]
+
     def refresh(self):
         if self:
             page = self._to_show or self.page
@@ -679,21 +944,55 @@ class ImageManager(QtCore.QObject):
             self._to_show = page
             self._load_page(page)
 
+    def take_prefetched(self, path):
+        """
+        Return the wrapper of the archive at path if it was already opened
+        in the background and None otherwise. The caller takes ownership.
+        """
+        worker = self._prefetcher
+        if worker is None or not worker.done or worker.path != path:
+            return None
+        self._prefetcher = None
+        return worker.wrapper
+
     def close(self):
         self.clearBuffers()
+        self._drop_prefetched()
         self._last_page = None
+        self._webcache.flush()
         if self.wrapper is not None:
-            self.wrapper.close()
+            # running workers might still read from the wrapper
+            self._retired.append(self.wrapper)
+            self._close_retired()
             self.wrapper = None
             self.imagelist = []
 
+    def shutdown(self):
+        """
+        Close the archive and stop the worker processes.
+        """
+        self.close()
+        if self._pool.waitForDone(self.shutdown_timeout):
+            self._cancelled.clear()
+            self._close_retired()
+        self._webcache.close()
+        self._diskcache.close()
+        if self._decoder is not None:
+            self._decoder.shutdown()
+            self._decoder = None
+
     def clearBuffers(self):
-        for worker in itervalues(self.workers):
-            worker.terminate()
-        self.workers.clear()
+        for page in list(self.workers):
+            self._cancel_load(page)
         self.viewer.scene().clear()
+        self._items = dict()
+        self._layout_run = None
+        self._span_starts = []
+        self._span_ends = []
+        self._span_pages = []
         self._images = dict()
         self._errors = dict()
+        self._segments.clear()
         self._to_show = None
 
     def get_buffered_image(self, page):
@@ -790,6 +1089,9 @@ class ImageManager(QtCore.QObject):
             origsize = item.data(self.DATA_ORIGSIZE)
             if origsize is not None:
                 infos['origsize'] = tuple(origsize)
+            timings = item.data(self.DATA_TIMINGS)
+            if timings:
+                infos['timings'] = timings
 
             if hasattr(zi, 'image_url'):
                 infos['image_url'] = zi.image_url
@@ -810,8 +1112,12 @@ class ImageManager(QtCore.QObject):
     def status_info(self):
         infos = self.page_description
         if self.workers:
-            loading = ','.join(text_type(p+1) for p in sorted(self.workers))
-            cinfo = f'Loading {loading}'
+            loading = sorted(p for p, w in iteritems(self.workers) if w.started)
+            loading = ','.join(text_type(p+1) for p in loading)
+            queued = sum(not w.started for w in itervalues(self.workers))
+            cinfo = f'Loading {loading}' if loading else 'Loading'
+            if queued:
+                cinfo = f'{cinfo} ({queued} queued)'
             infos['status'] = cinfo
         elif self.wrapper is None:
             infos['status'] = InfoBox.empty_label_str
@@ -821,8 +1127,10 @@ class ImageManager(QtCore.QObject):
 
     @property
     def loaded_pages(self):
-        scene = self.viewer.scene()
-        return dict((item.data(self.DATA_IND), item) for item in scene.items())
+        """
+        A read-only view of the items of the loaded pages by page.
+        """
+        return MappingProxyType(self._items)
 
     @property
     def path(self):
@@ -832,9 +1140,21 @@ class ImageManager(QtCore.QObject):
         self._booktimer.start(100)
 
     def _get_pixmap(self, page):
-        for item in self.viewer.scene().items():
-            if item.data(self.DATA_IND) == page:
-                return item
+        return self._items.get(page)
+
+    def _visible_items(self, view_rect):
+        """
+        Return the visible items overlapping the view_rect along the layout
+        axis of the mover.
+        """
+        if self._span_vertical:
+            low, high = view_rect.top(), view_rect.bottom()
+        else:
+            low, high = view_rect.left(), view_rect.right()
+        first = bisect_left(self._span_ends, low)
+        last = bisect_right(self._span_starts, high)
+        items = (self._items.get(p) for p in self._span_pages[first:last])
+        return [item for item in items if item is not None]
 
     def _view_page(self, view_rect):
         # search for the item at the center of the provided view_rect
@@ -844,7 +1164,7 @@ class ImageManager(QtCore.QObject):
         # overlap with the view_rect
         max_item = None
         max_surf = 0.0
-        for item in self.viewer.scene().items():
+        for item in self._visible_items(view_rect):
             if item.isVisible():
                 cur_bb = item.boundingRect()
                 intersection = cur_bb & view_rect
@@ -857,14 +1177,16 @@ class ImageManager(QtCore.QObject):
 
         return center_item or max_item
 
-    def _fit_image(self, img):
-        width, height = img.size
+    def _target_size(self, origsize):
+        """
+        Return the size an image of the given original size is scaled to.
+        """
+        width, height = origsize
         ratio = width/height
         view_rect = self.viewer.viewport().rect()
         swidth, sheight = view_rect.width(), view_rect.height()
         move_h = int(swidth*(100-self.settings.overlap)/100)
         move_v = int(sheight*(100-self.settings.overlap)/100)
-        origsize = width, height
 
         defwidth, defheight = 0, 0
         best_match = float('inf')
@@ -915,67 +1237,121 @@ class ImageManager(QtCore.QObject):
                 height = int(sheight+int(hdiff/move_v)*move_v)
                 width  = int(height*ratio)
 
-        csize = width, height
-        if csize == origsize:
-            img = img.convert('RGB')
-        elif csize[0] > .5*origsize[0]:
-            img = img.convert('RGB').resize(csize,Image.LANCZOS)
-        else:
-            img.thumbnail(csize,Image.LANCZOS)
-            img = img.convert('RGB')
-
-        return img
+        return width, height
 
-    def _load_page(self, page):
-        toload = page+1
-        vis_page = self.page
-        if vis_page is None:
-            vis_page = toload
+    def _fit_image(self, img):
+        return fit_image(img, self._target_size(img.size))
 
-        if page not in self.loaded_pages and page not in self.workers and \
+    def _load_page(self, page, priority=0):
+        """
+        Queue the given page in the thread pool. Pages with a higher priority
+        are decoded first.
+        """
+        if page not in self._items and page not in self.workers and \
           page >= 0 and page < len(self.imagelist):
-            self.workers[page] = worker = WorkerThread(self, page)
+            self.workers[page] = worker = PageWorker(self, page)
             worker.loaded.connect(self._insert_page)
-            worker.start()
+            self._pool.start(worker, priority)
 
         self.info_changed.emit(0)
 
-    def _insert_page(self, page):
+    def _cancel_load(self, page):
         worker = self.workers.pop(page)
+        if not self._pool.tryTake(worker):
+            # the worker is already running and its result will be dropped
+            worker.cancelled = True
+            self._cancelled.add(worker)
+
+    def _prefetch_next(self):
+        """
+        Open the next archive in the background once the preload window
+        reaches the last page.
+        """
+        worker = ArchivePrefetcher(self, self.settings.preload + 1)
+        self._prefetcher = worker
+        worker.loaded.connect(self._prefetched)
+        # the pages of the current archive are decoded first
+        self._pool.start(worker, -self.settings.preload - 1)
+
+    def _prefetched(self, worker):
+        worker.done = True
+        self._cancelled.discard(worker)
+        if worker is not self._prefetcher and worker.wrapper is not None:
+            worker.wrapper.close()
+
+    def _drop_prefetched(self):
+        worker = self._prefetcher
+        self._prefetcher = None
+        if worker is None:
+            return
+        if worker.done:
+            if worker.wrapper is not None:
+                worker.wrapper.close()
+        elif not self._pool.tryTake(worker):
+            # closed as soon as the prefetcher reports back
+            worker.cancelled = True
+            self._cancelled.add(worker)
+
+    def _close_retired(self):
+        """
+        Close the retired wrappers which are not used by any cancelled
+        worker anymore.
+        """
+        busy = [worker.wrapper for worker in self._cancelled]
+        retired = []
+        for wrapper in self._retired:
+            if any(wrapper is cur for cur in busy):
+                retired.append(wrapper)
+            else:
+                wrapper.close()
+        self._retired = retired
+
+    def _insert_page(self, worker):
+        page = worker.pos
+        if self.workers.get(page) is not worker:
+            self._cancelled.discard(worker)
+            self._close_retired()
+            return
+        if worker.qimage is not None and self._mover.merges_pages and \
+          self.get_buffered_image(page - 1) is not worker.prev_img:
+            # the previous page was inserted after the worker cropped this
+            # one, so the crop is redone in the pool before all other pages
+            self._pool.start(worker, 1)
+            return
+        del self.workers[page]
         scene = self.viewer.scene()
         error = worker.error
-        tops = worker.tops
-        bottoms = worker.bottoms
+        size = (10, 10) if worker.img is None else worker.img.size
+        image = None
+        pixmap = None
 
-        if worker.img is None:
-            size = 10, 10
-            image = None
+        try:
+            if worker.qimage is not None:
+                start = time.perf_counter()
+                pixmap = QtGui.QPixmap.fromImage(worker.qimage)
+                image = worker.qimage
+                worker.timings['upload'] = time.perf_counter() - start
+        except MemoryError:
+            error = error or ''
+            error = f'{error} MemoryError'.strip()
+
+        if image is None:
             pixmap = QtGui.QPixmap(*size)
+            img, tops, bottoms = worker.img, worker.tops, worker.bottoms
         else:
-            try:
-                size = worker.img.size
-                prevImg = self.get_buffered_image(page - 1)
-                worker.img = self._mover.crop_image(worker.img, prevImg)
-                image = ImageQt.ImageQt(worker.img)
-                pixmap = QtGui.QPixmap.fromImage(image)
-                dheight = worker.img.size[1] - size[1]
-                tops = [t + dheight for t in tops]
-                bottoms = [t + dheight for t in bottoms]
-            except MemoryError:
-                size = worker.img.size
-                image = None
-                pixmap = QtGui.QPixmap(*size)
-                error = error or ''
-                error = f'{error} MemoryError'.strip()
+            img = worker.display_img
+            tops, bottoms = worker.display_tops, worker.display_bottoms
 
         item = scene.addPixmap(pixmap)
+        self._items[page] = item
         item.setData(self.DATA_IND, page)
         item.setData(self.DATA_ORIGSIZE, worker.origsize)
         item.setData(self.DATA_SIZE, size)
         item.setData(self.DATA_TOPS, tops)
         item.setData(self.DATA_BOTTOMS, bottoms)
+        item.setData(self.DATA_TIMINGS, worker.timings)
         item.hide()
-        self._images[page] = image, worker.img
+        self._images[page] = image, img
         self._errors[page] = error
         self._reoder_items()
 
@@ -990,23 +1366,33 @@ class ImageManager(QtCore.QObject):
         if vis_page is None:
             return
 
-        loaded_pages = self.loaded_pages
-        existing = set(loaded_pages) | set(self.workers)
         preloading = set(range(vis_page+1, vis_page+self.settings.preload+1))
         preloading &= set(range(self.page_count))
-        loadcandidate = preloading-existing
 
-        if loadcandidate:
-            self._load_page(min(loadcandidate))
+        # drop queued pages which left the preload window
+        needed = preloading | {vis_page, self._to_show}
+        for page in set(self.workers) - needed:
+            self._cancel_load(page)
 
-        if len(loaded_pages) > self.settings.buffernumber:
+        existing = set(self._items) | set(self.workers)
+        for page in sorted(preloading-existing):
+            # closer pages get a higher priority than the ones further away
+            self._load_page(page, vis_page-page)
+
+        if self._prefetcher is None and \
+          vis_page + self.settings.preload >= self.page_count - 1 and \
+          not isinstance(self.wrapper, WebWrapper) and \
+          not self.wrapper.scanning:
+            self._prefetch_next()
+
+        if len(self._items) > self.settings.buffernumber:
             # .25 makes sure images before the current one get removed first
             # if they have the same distance to the image
             scene = self.viewer.scene()
             key = lambda x: abs(vis_page-x+.25)
-            srtpos = sorted(set(loaded_pages)-preloading,key=key)
+            srtpos = sorted(set(self._items)-preloading,key=key)
             for pos in srtpos[self.settings.buffernumber:]:
-                item = loaded_pages.pop(pos)
+                item = self._items.pop(pos)
                 scene.removeItem(item)
                 del self._images[pos]
 
@@ -1022,64 +1408,128 @@ class ImageManager(QtCore.QObject):
         self._last_page = vis_page
 
     def _reoder_items(self):
-        scene = self.viewer.scene()
         view_rect = self.viewer.viewport().rect()
         view_rect = self.viewer.mapToScene(view_rect).boundingRect()
-        items = self.loaded_pages
+        items = self._items
         if self._to_show is not None and self._to_show in items:
             view_page = self._to_show
         else:
             view_page = self.page
+
+        # show all pages directly connected to the currently page in focues
+        run = None
+        if view_page in items:
+            first = last = view_page
+            if self._mover.continuous:
+                while (first-1) in items:
+                    first -= 1
+                while (last+1) in items:
+                    last += 1
+            run = first, last
+
+        old_run = self._layout_run
+        if run is not None and old_run is not None and \
+          self._layout_mover is self._mover and \
+          run[0] <= old_run[1] and old_run[0] <= run[1]:
+            self._update_layout(run)
+        else:
+            self._full_layout(run, view_rect)
+
+    def _full_layout(self, run, view_rect):
+        """
+        Place all pages of the run next to each other starting at the origin
+        of the scene and hide all other pages.
+        """
+        scene = self.viewer.scene()
         view_item = self.pixmap_item
         if view_item is not None:
             view_shift = view_rect.center() - view_item.boundingRect().center()
 
-        # show all pages directly connected to the currently page in focues
-        pages = sorted(items)
-        show_pages = {view_page}
-        if self._mover.continuous:
-            try:
-                view_pos = pages.index(view_page)
-            except ValueError:
-                view_pos = 0
-            for cind in pages[view_pos+1:]:
-                if (cind-1) in show_pages:
-                    show_pages.add(cind)
-            for cind in pages[:view_pos][::-1]:
-                if (cind+1) in show_pages:
-                    show_pages.add(cind)
-
-        scene_rect = QtCore.QRectF(0, 0, 0, 0)
-        tops = []
-        bottoms = []
-        for cind, item in sorted(iteritems(items)):
-            if cind in show_pages:
-                item_rect = item.boundingRect()
-                scene_rect = self._mover.append_item(scene_rect, item_rect)
-                item.setOffset(item_rect.topLeft())
-                offset = int(item_rect.top())
-                for c in item.data(self.DATA_TOPS):
-                    tops.append(c + offset)
-                for c in item.data(self.DATA_BOTTOMS):
-                    bottoms.append(c + offset)
-
-        scene.setSceneRect(scene_rect)
-        self._mover.set_segments(tops, bottoms)
+        show_pages = set() if run is None else set(range(run[0], run[1]+1))
+        self._layout_rect = QtCore.QRectF(0, 0, 0, 0)
+        self._span_starts = []
+        self._span_ends = []
+        self._span_pages = []
+        self._span_vertical = self._mover.vertical
+        for cind in sorted(show_pages):
+            self._place_item(cind, self._mover.append_item)
+        for cind in self._segments.pages - show_pages:
+            self._segments.remove(cind)
+
+        scene.setSceneRect(self._layout_rect)
+        self._mover.segments = self._segments
+        self._layout_run = run
+        self._layout_mover = self._mover
         # shift view to show the same section as before the reorder
         if view_item is not None:
             ncenter = view_item.boundingRect().center() + view_shift
             self.viewer.centerOn(ncenter)
 
-        for cind, item in iteritems(items):
+        for cind, item in iteritems(self._items):
             item.setVisible(cind in show_pages)
 
-    def _store_image(self, filename, data):
-        base = Path(self.settings.webcache)
-        path = Path(base, self.wrapper.filename, filename)
-        if self.settings.webcache and base.is_dir() and not path.exists():
-            path.parent.mkdir(exist_ok=True)
-            with path.open('wb') as f:
-                f.write(data)
+    def _update_layout(self, run):
+        """
+        Change the shown pages from the current run to the overlapping run.
+        Pages are only added or removed at both ends, so all pages shown in
+        both runs keep their position.
+        """
+        first, last = run
+        old_first, old_last = self._layout_run
+        removed = [p for p in range(old_first, old_last+1)
+                   if p < first or p > last]
+        for cind in removed:
+            self._segments.remove(cind)
+            self._remove_span(cind)
+            item = self._items.get(cind)
+            if item is not None:
+                item.hide()
+
+        if removed:
+            # shrink the scene to the remaining pages
+            rect = QtCore.QRectF(0, 0, 0, 0)
+            for cind in range(max(first, old_first), min(last, old_last)+1):
+                rect = rect.united(self._items[cind].boundingRect())
+            self._layout_rect = rect
+
+        for cind in range(old_first-1, first-1, -1):
+            self._place_item(cind, self._mover.prepend_item)
+            self._items[cind].show()
+        for cind in range(old_last+1, last+1):
+            self._place_item(cind, self._mover.append_item)
+            self._items[cind].show()
+
+        self.viewer.scene().setSceneRect(self._layout_rect)
+        self._mover.segments = self._segments
+        self._layout_run = run
+
+    def _place_item(self, page, attach):
+        """
+        Move the item of the page to the position given by attach, one of
+        the append_item or prepend_item methods of the mover, and add it to
+        the scene rect, the segment index and the spans.
+        """
+        item = self._items[page]
+        item_rect = item.boundingRect()
+        self._layout_rect = attach(self._layout_rect, item_rect)
+        item.setOffset(item_rect.topLeft())
+        self._segments.update(page, int(item_rect.top()),
+                              item.data(self.DATA_TOPS),
+                              item.data(self.DATA_BOTTOMS))
+        if self._span_vertical:
+            start, end = item_rect.top(), item_rect.bottom()
+        else:
+            start, end = item_rect.left(), item_rect.right()
+        ind = bisect_right(self._span_starts, start)
+        self._span_starts.insert(ind, start)
+        self._span_ends.insert(ind, end)
+        self._span_pages.insert(ind, page)
+
+    def _remove_span(self, page):
+        ind = self._span_pages.index(page)
+        del self._span_starts[ind]
+        del self._span_ends[ind]
+        del self._span_pages[ind]
 
     def __bool__(self):
         return self.wrapper is not None and self.page is not None
@@ -1274,11 +1724,12 @@ class ImageViewer(QtWidgets.QGraphicsView):
                       if no images could be found in the archive.
         """
         try:
-            farch = open_wrapper(path)
+            farch = self.manager.take_prefetched(path) or open_wrapper(path)
             _, name = os.path.split(path)
             ntitle = f'{name} - Image Viewer'
             self.manager.open_archive(farch, page)
             self.setWindowTitle(ntitle)
+            farch.scan_archives()
             return True
 
         except WrapperIOError as err:
@@ -1374,7 +1825,7 @@ class ImageViewer(QtWidgets.QGraphicsView):
 
     def closeEvent(self,e):
         self.save_settings()
-        self.manager.close()
+        self.manager.shutdown()
         for farch in self.writing:
             farch.close()
 
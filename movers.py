@@ -5,6 +5,7 @@ Created on Mon Nov 13 20:47:28 2017
 @author: Caasar
 """
 from __future__ import division
+from bisect import bisect_left, bisect_right, insort
 
 #try:
 #    from PySide import QtCore
@@ -13,6 +14,56 @@ from __future__ import division
 
 INF_POINT = 1000000000
 
+def _channel_sum(arr):
+    """
+    Return the sum over the channels for each pixel as int16.
+    """
+    import numpy as np
+
+    total = arr[..., 0].astype(np.int16)
+    for channel in range(1, arr.shape[2]):
+        total += arr[..., channel]
+    return total
+
+
+def _line_distances(ref, arr, j0, j1, stop_thr):
+    """
+    Return the mean distance between the reference lines and the lines of
+    arr ending at the rows j0 to j1-1. The distance is inf if a single line
+    differs by more than stop_thr.
+
+    The difference between the channel sums of two pixels is a lower bound
+    for their distance, so most lines exceeding stop_thr are dropped
+    without a full comparison.
+    """
+    import numpy as np
+
+    nlines = len(ref)
+    lo = j0 - nlines + 1
+    sig_ref = _channel_sum(ref)
+    sig_arr = _channel_sum(arr[lo:j1])
+    sdists = np.zeros(j1 - j0)
+    # only keep comparing rows which did not exceed stop_thr yet
+    active = np.arange(j1 - j0)
+    for offset in range(nlines):
+        rows = active + (j0 - offset)
+        lower = np.abs(sig_arr[rows - lo] - sig_ref[offset]).max(1)
+        stopped = lower > 3 * stop_thr
+        sdists[active[stopped]] = np.inf
+        active = active[~stopped]
+        rows = rows[~stopped]
+
+        diff = np.abs(arr[rows] - ref[offset])
+        cdists = _channel_sum(diff).max(1) / 3
+        sdists[active] += cdists
+        stopped = cdists > stop_thr
+        sdists[active[stopped]] = np.inf
+        active = active[~stopped]
+        if len(active) == 0:
+            break
+    return sdists / nlines
+
+
 def crop_image(img, prevImg, thr=50.0, min_lines=25, stop_thr=150):
     try:
         import numpy as np
@@ -23,35 +74,43 @@ def crop_image(img, prevImg, thr=50.0, min_lines=25, stop_thr=150):
         return img
 
     assert img.size[0] == prevImg.size[0]
-    arr1 = np.asarray(prevImg).astype(np.float)
-    arr2 = np.asarray(img).astype(np.float)
-    for i in range(arr1.shape[0] - 1, -1, -1):
-        if arr1[i].min() < 254:
-            break
-
+    arr1 = np.asarray(prevImg)
+    arr2 = np.asarray(img)
+    arr1 = arr1.reshape(arr1.shape[0], arr1.shape[1], -1)
+    arr2 = arr2.reshape(arr2.shape[0], arr2.shape[1], -1)
+    # the last lines of the previous image which are not white have to be
+    # found at the start of the current image
+    nonwhite = np.flatnonzero(arr1.reshape(arr1.shape[0], -1).min(1) < 254)
+    i = nonwhite[-1] if len(nonwhite) else 0
+    ref = arr1[[i - offset for offset in range(min_lines)]].astype(np.int16)
+
+    # compare the candidate rows in growing blocks, so a match close to the
+    # top is found without comparing the whole image
     start = None
     mindist = np.inf
-    dists = []
-    for j in range(min_lines, arr2.shape[0]):
-        sdist = 0.0
-        for offset in range(min_lines):
-            cdist = np.abs(arr1[i-offset] - arr2[j-offset]).sum(1).max() / 3
-            sdist += cdist
-            if cdist > stop_thr:
-                sdist = np.inf
-                break
-        sdist /= min_lines
-        dists.append(sdist)
-        if sdist < mindist:
-            start = j + 1
-            mindist = sdist
-
-        if mindist < thr and sdist > thr:
+    j0 = min_lines
+    block = 32
+    while j0 < arr2.shape[0]:
+        j1 = min(j0 + block, arr2.shape[0])
+        sdists = _line_distances(ref, arr2, j0, j1, stop_thr)
+        # stop after the first row worse than thr once a match was found
+        runmin = np.minimum.accumulate(np.minimum(sdists, mindist))
+        stops = np.flatnonzero((runmin < thr) & (sdists > thr))
+        if len(stops):
+            sdists = sdists[:stops[0]+1]
+        best = int(np.argmin(sdists))
+        if sdists[best] < mindist:
+            start = j0 + best + 1
+            mindist = sdists[best]
+        if len(stops):
             break
+        j0 = j1
+        block = min(2 * block, 1024)
+
     if start is None:
-        for start in range(arr2.shape[0]):
-            if arr2[start].min() > 254:
-                break
+        rowmin = arr2.reshape(arr2.shape[0], -1).min(1)
+        white = np.flatnonzero(rowmin > 254)
+        start = int(white[0]) if len(white) else arr2.shape[0] - 1
 
     if start > 0:
         return img.crop((0, start, img.size[0], img.size[1]))
@@ -59,18 +118,124 @@ def crop_image(img, prevImg, thr=50.0, min_lines=25, stop_thr=150):
         return img
 
 
+def segment_image(img, max_irange=15, filter_len=5, min_rho=0.8):
+    """
+    Return the start and stop rows of the background sections of the image.
+    """
+    try:
+        import numpy as np
+        from scipy import ndimage
+    except ImportError:
+        return [], []
+
+    arr = np.asarray(img.convert('L'))
+    # find the intensity range for each row
+    arrMin = arr.min(1).astype(np.int16)
+    arrMax = arr.max(1).astype(np.int16)
+    arrRange = arrMax - arrMin
+    # ensure minimal range for each row is >= MaxIRange to ensure
+    # a stable calculation of the correlation coeficient
+    arrOff = np.maximum(max_irange - arrRange, 0) // 2
+    arrMin -= arrOff
+    arrMax += arrOff
+    # build the reference intensity range based on the center
+    # of the two neighbouring rows
+    refCenter = np.empty_like(arrMin)
+    refCenter[1:-1] = arrMax[:-2] + arrMax[2:] + arrMin[:-2] + arrMin[2:]
+    refCenter >>= 2
+    refCenter[0] = (arrMax[1] + arrMin[1]) // 2
+    refCenter[-1] = (arrMax[-2] + arrMin[-2]) // 2
+    refMin = refCenter - max_irange // 2
+    refMax = refCenter + max_irange // 2
+    # calculate the correlation coeficient rho
+    compMin = np.maximum(arrMin, refMin)
+    compMax = np.minimum(arrMax, refMax)
+    compRange = np.maximum(compMax - compMin, 0)
+    rhos = compRange / np.sqrt(max_irange * (arrMax - arrMin))
+    # consider rows with a rho larger than MinRho to be background
+    # and use a binary openinig to remove noise detecions
+    isw = ndimage.binary_opening(rhos > min_rho,
+                                 structure=np.ones(filter_len, bool))
+    # find the start and stop index for the background rows
+    start = np.flatnonzero(isw[:-1] & (~isw[1:])) - filter_len + 1
+    stop = np.flatnonzero((~isw[:-1]) & isw[1:]) + filter_len + 1
+    start = start.tolist()
+    stop = stop.tolist()
+
+    if not np.all(isw):
+        if len(start) == 0:
+            start.insert(0, 0)
+        if len(stop) == 0:
+            stop.append(len(arr))
+
+        if start[0] > stop[0]:
+            start.insert(0, 0)
+        if stop[-1] < start[-1]:
+            stop.append(len(arr))
+
+    return start, stop
+
+
+class SegmentIndex(object):
+    """
+    Sorted tops and bottoms of the segments of all visible pages.
+
+    The segments are added and removed page by page, so only the pages
+    which changed have to be updated when the layout changes.
+    """
+    def __init__(self):
+        self.tops = []
+        self.bottoms = []
+        self._pages = dict()
+
+    def update(self, page, offset, tops, bottoms):
+        """
+        Set the segments of the page, shifted by offset into scene
+        coordinates. Nothing is done if the page is already stored with the
+        same offset.
+        """
+        current = self._pages.get(page)
+        if current is not None and current[0] == offset:
+            return
+        self.remove(page)
+        tops = [t + offset for t in tops]
+        bottoms = [b + offset for b in bottoms]
+        self._pages[page] = offset, tops, bottoms
+        for t in tops:
+            insort(self.tops, t)
+        for b in bottoms:
+            insort(self.bottoms, b)
+
+    def remove(self, page):
+        offset, tops, bottoms = self._pages.pop(page, (None, [], []))
+        for t in tops:
+            del self.tops[bisect_left(self.tops, t)]
+        for b in bottoms:
+            del self.bottoms[bisect_left(self.bottoms, b)]
+
+    def clear(self):
+        self.tops = []
+        self.bottoms = []
+        self._pages.clear()
+
+    @property
+    def pages(self):
+        return set(self._pages)
+
+
 class BaseMover(object):
     MaxIRange = 15
     FilterLen = 5
     MinRho = 0.8
+    # defines if append_item stacks the items vertically or horizontally
+    vertical = True
 
     def __init__(self, viewer, name):
         self.viewer = viewer
         self.name = name
         self._continuous = False
         self._merge_threshold = 50.0
-        self._tops = []
-        self._bottoms = []
+        self.segments = SegmentIndex()
 
     def step_sizes(self, overlap):
         """
@@ -119,7 +284,7 @@ class BaseMover(object):
         raise NotImplementedError()
 
     def crop_image(self, img, prevImg):
-        if prevImg is not None and self.continuous_height:
+        if prevImg is not None and self.merges_pages:
             return crop_image(img, prevImg, self._merge_threshold)
         else:
             return img
@@ -127,63 +292,12 @@ class BaseMover(object):
     def segment_image(self, img):
         if not self._continuous:
             return [], []
-        try:
-            import numpy as np
-            from scipy import ndimage
-        except ImportError:
-            return [], []
-
-        arr = np.asarray(img.convert('L'))
-        # find the intensity range for each row
-        arrMin = arr.min(1).astype(np.int16)
-        arrMax = arr.max(1).astype(np.int16)
-        arrRange = arrMax - arrMin
-        # ensure minimal range for each row is >= MaxIRange to ensure
-        # a stable calculation of the correlation coeficient
-        arrOff = np.maximum(self.MaxIRange - arrRange, 0) // 2
-        arrMin -= arrOff
-        arrMax += arrOff
-        # build the reference intensity range based on the center
-        # of the two neighbouring rows
-        refCenter = np.empty_like(arrMin)
-        refCenter[1:-1] = arrMax[:-2] + arrMax[2:] + arrMin[:-2] + arrMin[2:]
-        refCenter >>= 2
-        refCenter[0] = (arrMax[1] + arrMin[1]) // 2
-        refCenter[-1] = (arrMax[-2] + arrMin[-2]) // 2
-        refMin = refCenter - self.MaxIRange // 2
-        refMax = refCenter + self.MaxIRange // 2
-        # calculate the correlation coeficient rho
-        compMin = np.maximum(arrMin, refMin)
-        compMax = np.minimum(arrMax, refMax)
-        compRange = np.maximum(compMax - compMin, 0)
-        rhos = compRange / np.sqrt(self.MaxIRange * (arrMax - arrMin))
-        # consider rows with a rho larger than MinRho to be background
-        # and use a binary openinig to remove noise detecions
-        isw = ndimage.binary_opening(rhos > self.MinRho,
-                                     structure=np.ones(self.FilterLen, bool))
-        # find the start and stop index for the background rows
-        start = np.flatnonzero(isw[:-1] & (~isw[1:])) - self.FilterLen + 1
-        stop = np.flatnonzero((~isw[:-1]) & isw[1:]) + self.FilterLen + 1
-        start = start.tolist()
-        stop = stop.tolist()
-
-        if not np.all(isw):
-            if len(start) == 0:
-                start.insert(0, 0)
-            if len(stop) == 0:
-                stop.append(len(arr))
-
-            if start[0] > stop[0]:
-                start.insert(0, 0)
-            if stop[-1] < start[-1]:
-                stop.append(len(arr))
-
-        return start, stop
-
+        return segment_image(img, self.MaxIRange, self.FilterLen, self.MinRho)
 
     def set_segments(self, tops, bottoms):
-        self._tops = tops[::-1]
-        self._bottoms = bottoms
+        segments = SegmentIndex()
+        segments.update(None, 0, tops, bottoms)
+        self.segments = segments
 
     @property
     def continuous(self):
@@ -201,6 +315,13 @@ class BaseMover(object):
     def merge_threshold(self, thr):
         self._merge_threshold = thr
 
+    @property
+    def merges_pages(self):
+        """
+        Whether crop_image removes the overlap with the previous page.
+        """
+        return self.continuous_height and self._merge_threshold > 0.0
+
     @property
     def continuous_height(self):
         raise NotImplementedError()
@@ -213,27 +334,37 @@ class BaseMover(object):
     def append_item(cls, scene_rect, item_rect):
         return item_rect
 
+    @classmethod
+    def prepend_item(cls, scene_rect, item_rect):
+        return item_rect
+
     def _next_segment(self, view, dy):
+        tops = self.segments.tops
+        bottoms = self.segments.bottoms
         viewTop = int(view.top())
         viewBottom = int(view.bottom())
         nextBottom = viewBottom + dy
-        minTop = viewTop
+
+        # the last bottom reachable with the step and the last one visible
+        hi = bisect_right(bottoms, nextBottom)
         targetBottom = None
-        targetTop = None
-        for cb in self._bottoms:
-            if nextBottom < cb:
-                break
-            if viewBottom < cb:
-                targetBottom = cb
-            elif minTop < cb:
-                minTop = cb
+        if hi > 0 and viewBottom < bottoms[hi-1]:
+            targetBottom = bottoms[hi-1]
+        minTop = viewTop
+        ind = bisect_right(bottoms, viewBottom, 0, hi)
+        if ind > 0 and minTop < bottoms[ind-1]:
+            minTop = bottoms[ind-1]
 
+        # the last top above the bottom of the view which starts after
+        # minTop or else the first top below the view
         minTop -= 2 * self.FilterLen
-        for ct in self._tops:
-            if viewTop < minTop and minTop < ct:
-                targetTop = ct
-            if ct < viewBottom:
-                break
+        targetTop = None
+        if viewTop < minTop:
+            ind = bisect_left(tops, viewBottom)
+            if ind > 0 and minTop < tops[ind-1]:
+                targetTop = tops[ind-1]
+            elif ind < len(tops):
+                targetTop = tops[ind]
 
         if targetTop is not None:
             return targetTop - viewTop
@@ -243,28 +374,32 @@ class BaseMover(object):
             return dy
 
     def _prev_segment(self, view, dy):
+        tops = self.segments.tops
+        bottoms = self.segments.bottoms
         viewTop = int(view.top())
         viewBottom = int(view.bottom())
-
-
         nextTop = viewTop - dy
-        maxBottom = viewBottom
+
+        # the first top reachable with the step and the first one visible
+        lo = bisect_left(tops, nextTop)
         targetTop = None
-        targetBottom = None
-        for ct in self._tops:
-            if ct < nextTop:
-                break
-            if ct < viewTop:
-                targetTop = ct
-            elif ct < maxBottom:
-                maxBottom = ct
+        if lo < len(tops) and tops[lo] < viewTop:
+            targetTop = tops[lo]
+        maxBottom = viewBottom
+        ind = bisect_left(tops, viewTop, lo)
+        if ind < len(tops) and tops[ind] < maxBottom:
+            maxBottom = tops[ind]
 
+        # the first bottom below the top of the view which ends before
+        # maxBottom or else the last bottom above the view
         maxBottom += 2 * self.FilterLen
-        for cb in self._bottoms:
-            if maxBottom < viewBottom and cb < maxBottom:
-                targetBottom = cb
-            if viewTop < cb:
-                break
+        targetBottom = None
+        if maxBottom < viewBottom:
+            ind = bisect_right(bottoms, viewTop)
+            if ind < len(bottoms) and bottoms[ind] < maxBottom:
+                targetBottom = bottoms[ind]
+            elif ind > 0:
+                targetBottom = bottoms[ind-1]
 
         if targetBottom is not None:
             return viewBottom - targetBottom
@@ -283,6 +418,8 @@ class BaseMover(object):
         return isinstance(other, BaseMover) and other.name == self.name
 
 class DownLeftMover(BaseMover):
+    vertical = False
+
     def __init__(self, viewer):
         super(DownLeftMover, self).__init__(viewer, 'Down Left')
 
@@ -292,6 +429,12 @@ class DownLeftMover(BaseMover):
         item_rect.moveTopRight(refPoint)
         return scene_rect.united(item_rect)
 
+    @classmethod
+    def prepend_item(cls, scene_rect, item_rect):
+        refPoint = scene_rect.topRight()
+        item_rect.moveTopLeft(refPoint)
+        return scene_rect.united(item_rect)
+
     def next_view(self, overlap):
         dx, dy, view, scene = self.step_sizes(overlap)
         if scene.bottom() > view.bottom():
@@ -330,6 +473,8 @@ class DownLeftMover(BaseMover):
 
 
 class DownRightMover(BaseMover):
+    vertical = False
+
     def __init__(self, viewer):
         super(DownRightMover, self).__init__(viewer, 'Down Right')
 
@@ -339,6 +484,12 @@ class DownRightMover(BaseMover):
         item_rect.moveTopLeft(refPoint)
         return scene_rect.united(item_rect)
 
+    @classmethod
+    def prepend_item(cls, scene_rect, item_rect):
+        refPoint = scene_rect.topLeft()
+        item_rect.moveTopRight(refPoint)
+        return scene_rect.united(item_rect)
+
     def next_view(self, overlap):
         dx, dy, view, scene = self.step_sizes(overlap)
         if scene.bottom() > view.bottom():
@@ -386,6 +537,12 @@ class RightDownMover(BaseMover):
         item_rect.moveTopLeft(refPoint)
         return scene_rect.united(item_rect)
 
+    @classmethod
+    def prepend_item(cls, scene_rect, item_rect):
+        refPoint = scene_rect.topLeft()
+        item_rect.moveBottomLeft(refPoint)
+        return scene_rect.united(item_rect)
+
     def next_view(self, overlap):
         dx, dy, view, scene = self.step_sizes(overlap)
         dy = self._next_segment(view, dy)
@@ -435,6 +592,12 @@ class LeftDownMover(BaseMover):
         item_rect.moveTopRight(refPoint)
         return scene_rect.united(item_rect)
 
+    @classmethod
+    def prepend_item(cls, scene_rect, item_rect):
+        refPoint = scene_rect.topRight()
+        item_rect.moveBottomRight(refPoint)
+        return scene_rect.united(item_rect)
+
     def next_view(self, overlap):
         dx, dy, view, scene = self.step_sizes(overlap)
         dy = self._next_segment(view, dy)
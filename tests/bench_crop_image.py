@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of movers.crop_image against the former loop based implementation
+on tall webtoon strips.
+
+Run it from the repository root with ``python tests/bench_crop_image.py``.
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from movers import crop_image
+from test_movers import reference_crop_image, make_strip, split_strip
+
+
+def timeit(func, *args, repeat=3):
+    best = np.inf
+    for dummy in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f'{"case":<24}{"height":>8}{"loop":>10}{"vector":>10}{"speedup":>9}')
+    for height in (2000, 8000, 16000):
+        strip = make_strip(rng, height + 600, width=720)
+        cases = {
+            # the overlap is found close to the top of the page
+            'overlap': split_strip(rng, strip, 600, 120, noise=8),
+            # no overlap, so every row of the page is compared
+            'no overlap': (make_strip(rng, 600, width=720),
+                           strip.crop((0, 600, 720, height + 600))),
+        }
+        for name, (prev, img) in cases.items():
+            told, expected = timeit(reference_crop_image, img, prev, repeat=1)
+            tnew, result = timeit(crop_image, img, prev)
+            assert result.size == expected.size
+            print(f'{name:<24}{img.size[1]:>8}{told:>9.3f}s{tnew:>9.3f}s'
+                  f'{told / tnew:>8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Compares movers.crop_image against the loop based implementation it
+replaced.
+"""
+import numpy as np
+import PIL.Image as Image
+import pytest
+
+from movers import crop_image
+
+
+def reference_crop_image(img, prevImg, thr=50.0, min_lines=25, stop_thr=150):
+    """
+    The former implementation of crop_image, kept as reference.
+    """
+    if thr <= 0.0:
+        return img
+
+    assert img.size[0] == prevImg.size[0]
+    arr1 = np.asarray(prevImg).astype(np.float64)
+    arr2 = np.asarray(img).astype(np.float64)
+    if arr1.ndim == 2:
+        arr1 = arr1[..., None]
+        arr2 = arr2[..., None]
+    for i in range(arr1.shape[0] - 1, -1, -1):
+        if arr1[i].min() < 254:
+            break
+
+    start = None
+    mindist = np.inf
+    for j in range(min_lines, arr2.shape[0]):
+        sdist = 0.0
+        for offset in range(min_lines):
+            cdist = np.abs(arr1[i-offset] - arr2[j-offset]).sum(1).max() / 3
+            sdist += cdist
+            if cdist > stop_thr:
+                sdist = np.inf
+                break
+        sdist /= min_lines
+        if sdist < mindist:
+            start = j + 1
+            mindist = sdist
+
+        if mindist < thr and sdist > thr:
+            break
+    if start is None:
+        for start in range(arr2.shape[0]):
+            if arr2[start].min() > 254:
+                break
+
+    if start > 0:
+        return img.crop((0, start, img.size[0], img.size[1]))
+    else:
+        return img
+
+
+def make_strip(rng, height, width=48, mode='RGB', white=()):
+    """
+    Return a random strip with smooth rows, like a scanned page, where the
+    row ranges in white are blank.
+    """
+    base = rng.integers(0, 256, (height, 1, 3)).astype(np.int16)
+    noise = rng.integers(-20, 21, (height, width, 3))
+    arr = np.clip(base + noise, 0, 255).astype(np.uint8)
+    for start, stop in white:
+        arr[start:stop] = 255
+    img = Image.fromarray(arr, 'RGB')
+    return img.convert(mode)
+
+
+def split_strip(rng, strip, cut, overlap, noise=0):
+    """
+    Split strip at cut into two pages, which overlap by overlap rows. The
+    second page gets some noise, like a recompressed image.
+    """
+    width, height = strip.size
+    prev = strip.crop((0, 0, width, cut))
+    arr = np.asarray(strip.crop((0, cut - overlap, width, height)))
+    if noise:
+        arr = arr.astype(np.int16) + rng.integers(-noise, noise + 1,
+                                                  arr.shape)
+        arr = np.clip(arr, 0, 255).astype(np.uint8)
+    return prev, Image.fromarray(arr, strip.mode)
+
+
+def assert_same_crop(img, prev, **kwargs):
+    expected = reference_crop_image(img, prev, **kwargs)
+    result = crop_image(img, prev, **kwargs)
+    assert result.size == expected.size
+    assert result.tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize('seed', range(12))
+@pytest.mark.parametrize('mode', ['RGB', 'L'])
+def test_overlapping_pages(seed, mode):
+    rng = np.random.default_rng(seed)
+    strip = make_strip(rng, 400, mode=mode)
+    cut = int(rng.integers(120, 260))
+    overlap = int(rng.integers(0, 80))
+    prev, img = split_strip(rng, strip, cut, overlap, noise=seed % 4 * 5)
+    assert_same_crop(img, prev)
+
+
+@pytest.mark.parametrize('seed', range(6))
+def test_unrelated_pages(seed):
+    rng = np.random.default_rng(100 + seed)
+    white = [(0, int(rng.integers(0, 40)))] if seed % 2 else []
+    prev = make_strip(rng, 200)
+    img = make_strip(rng, 300, white=white)
+    assert_same_crop(img, prev)
+
+
+@pytest.mark.parametrize('seed', range(6))
+def test_white_borders(seed):
+    rng = np.random.default_rng(200 + seed)
+    strip = make_strip(rng, 400, white=[(150, 190), (380, 400)])
+    prev, img = split_strip(rng, strip, 260 + 10 * seed, 60)
+    assert_same_crop(img, prev)
+    assert_same_crop(img, prev, min_lines=10, stop_thr=60)
+
+
+@pytest.mark.parametrize('thr', [0.0, 5.0, 50.0, 200.0])
+def test_thresholds(thr):
+    rng = np.random.default_rng(300)
+    strip = make_strip(rng, 400)
+    prev, img = split_strip(rng, strip, 200, 40, noise=15)
+    assert_same_crop(img, prev, thr=thr)
+
+
+def test_blank_pages():
+    blank = Image.new('RGB', (48, 120), (255, 255, 255))
+    rng = np.random.default_rng(400)
+    page = make_strip(rng, 120)
+    assert_same_crop(blank, page)
+    assert_same_crop(page, blank)
+    assert_same_crop(blank, blank)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the AsyncEngine against a local http.server serving a synthetic web
+comic.
+"""
+import json
+import socket
+import threading
+import time
+from io import BytesIO
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+import PIL.Image as Image
+import wrapper.web as web
+
+PAGES = 500
+
+
+def page_html(num):
+    next_link = ''
+    if num < PAGES:
+        next_link = f'<a id="next" href="/page{num + 1}.html">next</a>'
+    return (f'<html><head><title>Comic {num}</title></head><body>'
+            f'<div id="comic"><img src="/img{num}.png"></div>'
+            f'{next_link}</body></html>').encode('utf-8')
+
+
+def page_image(num):
+    buf = BytesIO()
+    Image.new('L', (8, 12), num % 256).save(buf, 'png')
+    return buf.getvalue()
+
+
+class ComicHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the number of failed responses left per path
+    failures = dict()
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        # headers and body are sent separately, which stalls on delayed acks
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def respond(self, send_body):
+        path = self.path
+        status, headers, body = 200, {}, b''
+        with self.lock:
+            failures = self.failures.get(path, 0)
+            if failures:
+                self.failures[path] = failures - 1
+        if failures:
+            status = 503
+        elif path.startswith('/page'):
+            headers['Content-Type'] = 'text/html; charset=utf-8'
+            body = page_html(int(path[5:-5]))
+        elif path.startswith('/img'):
+            headers['Content-Type'] = 'image/png'
+            body = page_image(int(path[4:-4]))
+        elif path == '/headers':
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(dict(self.headers)).encode('utf-8')
+        elif path == '/slow':
+            time.sleep(1.0)
+            body = b'slow'
+        elif path == '/redirect':
+            status = 302
+            headers['Location'] = '/page1.html'
+        else:
+            status = 404
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ComicHandler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(scope='module')
+def engine():
+    engine = web.AsyncEngine()
+    engine.backoff = 0.01
+    yield engine
+    engine.close()
+
+
+def test_get(server, engine):
+    resp = engine.get(server + '/page3.html')
+    assert resp.status_code == 200
+    assert resp.headers['content-type'].startswith('text/html')
+    assert resp.content == page_html(3)
+    assert '<title>Comic 3</title>' in resp.text
+    with engine.get(server + '/img3.png') as resp:
+        assert resp.content == page_image(3)
+
+
+def test_head(server, engine):
+    resp = engine.head(server + '/img7.png')
+    assert resp.status_code == 200
+    assert int(resp.headers['content-length']) == len(page_image(7))
+    assert resp.content == b''
+    assert engine.probe(server + '/img7.png').result() == \
+           len(page_image(7))
+
+
+def test_redirects(server, engine):
+    assert engine.head(server + '/redirect').status_code == 302
+    resp = engine.get(server + '/redirect')
+    assert resp.status_code == 200
+    assert resp.url.endswith('/page1.html')
+    resp = engine.get(server + '/redirect', allow_redirects=False)
+    assert resp.status_code == 302
+
+
+def test_errors(server, engine):
+    resp = engine.get(server + '/missing')
+    assert resp.status_code == 404
+    with pytest.raises(web.WebIOError):
+        resp.raise_for_status()
+    assert engine.probe(server + '/missing').result() == 0
+
+    ComicHandler.failures['/page9.html'] = 2
+    resp = engine.get(server + '/page9.html')
+    assert resp.status_code == 200
+    assert resp.content == page_html(9)
+
+
+def test_headers(server, engine):
+    resp = engine.get(server + '/headers', headers={'X-Test': 'comic'})
+    assert json.loads(resp.text)['X-Test'] == 'comic'
+
+
+def test_timeout(server, engine):
+    with pytest.raises(web.WebIOError):
+        engine.get(server + '/slow', timeout=0.1)
+    with pytest.raises(web.WebIOError):
+        engine.get(server + '/slow', timeout=(1.0, 0.1))
+    assert engine.get(server + '/slow', timeout=5).content == b'slow'
+
+
+def test_unknown_arguments(server, engine):
+    with pytest.raises(TypeError):
+        engine.get(server + '/page1.html', stream=True)
+
+
+def test_close(server):
+    engine = web.AsyncEngine()
+    assert engine.get(server + '/page1.html').status_code == 200
+    engine.close()
+    assert not engine._thread.is_alive()
+    assert engine.session.closed
+    # closing twice, like at exit, does nothing
+    engine.close()
+
+
+def test_web_comic(server, engine, monkeypatch):
+    monkeypatch.setattr(web, '_SESSION', engine)
+    monkeypatch.setattr(web.WebWrapper, 'lookahead', PAGES)
+    monkeypatch.setitem(web.WebWrapper.profiles, 'test',
+                        {'url': server, 'img': '#comic > img',
+                         'next': '#next'})
+    wrapper = web.WebWrapper(server + '/page1.html')
+    try:
+        deadline = time.monotonic() + 60
+        while len(wrapper.filelist) < PAGES and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert [fi.page_url for fi in wrapper.filelist] == \
+               [f'{server}/page{num}.html' for num in range(1, PAGES + 1)]
+        for pos in (0, 250, PAGES - 1):
+            with wrapper.open(wrapper.filelist[pos], 'rb') as fin:
+                assert fin.read() == page_image(pos + 1)
+    finally:
+        wrapper.close()
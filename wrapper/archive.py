@@ -6,21 +6,258 @@ Created on Sat Nov 11 18:50:02 2017
 """
 
 import sys
-import zipfile, os, re
-from collections import namedtuple
-from subprocess import run, CREATE_NO_WINDOW
-from io import BytesIO
+import zipfile, tarfile, os, re
+import mmap
+import struct
+import threading
+import tempfile
+import shutil
+from collections import namedtuple, OrderedDict, Counter
+import subprocess
+from subprocess import run
+from io import BytesIO, RawIOBase
 from six import text_type
-from .base import WrapperIOError, BaseWrapper, KNOWN_ARCHIVES
+from .base import WrapperIOError, BaseWrapper, KNOWN_ARCHIVES, has_format
 
-KNOWN_ARCHIVES.update({'.zip','.cbz'})
+CREATE_NO_WINDOW = getattr(subprocess, 'CREATE_NO_WINDOW', 0)
 
+try:
+    import py7zr
+except ImportError:
+    py7zr = None
 
-class Handle7z(object):
+try:
+    import rarfile
+except ImportError:
+    rarfile = None
+
+# number of bytes needed to check all registered magic numbers
+MAGIC_SIZE = 262
+
+ArchiveHandler = namedtuple('ArchiveHandler', ('factory', 'formats', 'magic'))
+ARCHIVE_HANDLERS = []
+
+
+class ArchiveIOError(WrapperIOError):
+    pass
+
+
+def register_handler(factory, formats, magic=()):
+    """
+    Register a handler for archives. Handlers registered first take
+    precedence.
+
+    Parameters
+    ----------
+    factory : callable
+        Called with the path and the mode of the archive. Returns a handle
+        with a ``filelist`` property, ``read(fileinfo)`` and ``close()``.
+    formats : set
+        The file extensions of the supported archives.
+    magic : sequence
+        Pairs of offset and bytes identifying the archive by its content.
+    """
+    ARCHIVE_HANDLERS.append(ArchiveHandler(factory, frozenset(formats),
+                                           tuple(magic)))
+    KNOWN_ARCHIVES.update(formats)
+
+
+def find_handler(path, mode='r'):
+    """
+    Return the factory of the handler for the archive at path or None.
+    Existing archives are identified by their magic number first and by
+    their file extension otherwise.
+    """
+    if mode[0] != 'w':
+        try:
+            with open(path, 'rb') as fin:
+                head = fin.read(MAGIC_SIZE)
+        except OSError:
+            head = b''
+        for handler in ARCHIVE_HANDLERS:
+            for offset, magic in handler.magic:
+                if head[offset:offset+len(magic)] == magic:
+                    return handler.factory
+
+    for handler in ARCHIVE_HANDLERS:
+        if has_format(path, handler.formats):
+            return handler.factory
+    return None
+
+
+def open_zip(path, mode):
+    try:
+        return zipfile.ZipFile(path, mode)
+    except zipfile.BadZipfile as err:
+        raise ArchiveIOError(text_type(err))
+
+
+class HandleTar(object):
+    """
+    Reads tar archives in process. Members of compressed archives are read
+    by seeking in the decompressed stream, which is slower for backward
+    jumps but needs no temporary files.
+    """
+    FileType = namedtuple('FileType', ('filename', ))
+    formats = {'.tar', '.cbt', '.tgz', '.tbz2', '.txz',
+               '.tar.gz', '.tar.bz2', '.tar.xz'}
+
+    def __init__(self, path, mode):
+        if mode[0] != 'r':
+            raise ArchiveIOError("Unsupported file mode '%s' for HandleTar" % mode)
+        try:
+            self._archive = tarfile.open(path, 'r:*')
+            members = self._archive.getmembers()
+        except (tarfile.TarError, EOFError, OSError) as err:
+            raise ArchiveIOError(text_type(err))
+        self._members = {ti.name: ti for ti in members if ti.isfile()}
+        self._filelist = [self.FileType(name) for name in self._members]
+        self._lock = threading.Lock()
+
+    def read(self, fileinfo):
+        try:
+            member = self._members[fileinfo.filename]
+        except KeyError:
+            raise ArchiveIOError('"%s" not found in archive' % fileinfo.filename)
+        with self._lock:
+            try:
+                with self._archive.extractfile(member) as fin:
+                    return fin.read()
+            except (tarfile.TarError, EOFError, OSError) as err:
+                raise ArchiveIOError(text_type(err))
+
+    def close(self):
+        self._archive.close()
+
+    @property
+    def filelist(self):
+        return list(self._filelist)
+
+
+class BatchHandle(object):
+    """
+    Base class for handles which extract the members of an archive into a
+    temporary folder.
+
+    Members are extracted in batches. A read of an uncached member also
+    extracts the following ``prefetch`` members in the same call, so solid
+    archives are not decompressed from the start of the solid block for
+    every page. The extracted files are dropped again once they need more
+    than ``maxbytes``, except for the ones which are currently read.
+    """
     FileType = namedtuple('FileType', ('filename', ))
+
+    def __init__(self, path, filelist, prefetch=8, maxbytes=256*2**20):
+        self.path = path
+        self._filelist = filelist
+        self.prefetch = prefetch
+        self.maxbytes = maxbytes
+        self._order = sorted((fi.filename for fi in filelist),
+                             key=BaseWrapper.split_filename)
+        self._index = {name: i for i, name in enumerate(self._order)}
+        self._extracted = OrderedDict()
+        # the number of running reads of each member
+        self._reading = Counter()
+        self._nbytes = 0
+        self._tmpdir = None
+        self._lock = threading.Lock()
+
+    def read(self, fileinfo):
+        filename = fileinfo.filename
+        with self._lock:
+            if filename not in self._extracted:
+                self._extract(self._batch(filename))
+            self._extracted.move_to_end(filename)
+            self._reading[filename] += 1
+            fullpath = os.path.join(self._tmpdir, filename)
+        try:
+            with open(fullpath, 'rb') as fin:
+                return fin.read()
+        except OSError as err:
+            raise ArchiveIOError(text_type(err))
+        finally:
+            with self._lock:
+                self._reading[filename] -= 1
+                if not self._reading[filename]:
+                    del self._reading[filename]
+
+    def close(self):
+        with self._lock:
+            if self._tmpdir is not None:
+                shutil.rmtree(self._tmpdir, ignore_errors=True)
+                self._tmpdir = None
+            self._extracted.clear()
+            self._nbytes = 0
+
+    @property
+    def filelist(self):
+        return list(self._filelist)
+
+    def _extract_members(self, names):
+        """
+        Extract the members names into the temporary folder.
+        """
+        raise NotImplementedError()
+
+    def _batch(self, filename):
+        """
+        Return the member filename and the following members in page order
+        which are not extracted yet.
+        """
+        start = self._index.get(filename)
+        if start is None:
+            return [filename]
+        batch = [filename]
+        for name in self._order[start+1:]:
+            if len(batch) > self.prefetch:
+                break
+            if name not in self._extracted:
+                batch.append(name)
+        return batch
+
+    def _extract(self, names):
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp(prefix='imageviewer_')
+        error = None
+        try:
+            self._extract_members(names)
+        except ArchiveIOError as err:
+            error = err
+
+        for name in names:
+            fullpath = os.path.join(self._tmpdir, name)
+            if os.path.isfile(fullpath) and name not in self._extracted:
+                nbytes = os.path.getsize(fullpath)
+                self._extracted[name] = nbytes
+                self._nbytes += nbytes
+        if names[0] not in self._extracted:
+            if error is None:
+                error = ArchiveIOError('"%s" could not be extracted' % names[0])
+            raise error
+        self._shrink(keep=names[0])
+
+    def _shrink(self, keep):
+        for name in list(self._extracted):
+            if self._nbytes <= self.maxbytes:
+                break
+            if name == keep or name in self._reading:
+                continue
+            self._nbytes -= self._extracted.pop(name)
+            try:
+                os.remove(os.path.join(self._tmpdir, name))
+            except OSError:
+                pass
+
+
+class Handle7z(BatchHandle):
+    """
+    Reads archives with an external 7z executable.
+    """
+    executable = next((exe for exe in ('7z', '7zz', '7za')
+                       if shutil.which(exe)), None)
     re_row = re.compile(r'^\d+-\d+-\d+ \d+:\d+:\d+\s+\.\.\.\.[\.A]\s+\d+\s+\d+')
-    filelist_cmd = '7z.exe', '-ba', 'l', '--'
-    fileread_cmd = '7z.exe', '-so', 'e', '--'
+    filelist_args = '-ba', 'l', '--'
+    extract_args = 'x', '-y', '-bso0', '-bsp0', '-spd', '-scsUTF-8'
     formats = {'.7z', '.ar', '.arj', '.bzip2', '.cab', '.chm', '.cpio',
                '.cramfs', '.dmg', '.ext', '.fat', '.gpt', '.gzip', '.hfs',
                '.ihex', '.iso', '.lzh', '.lzma', '.mbr', '.msi', '.nsis',
@@ -28,12 +265,12 @@ class Handle7z(object):
                '.udf', '.uefi', '.vdi', '.vhd', '.vmdk', '.wim', '.xar',
                '.xz', '.z', '.zip', '.cbr'}
 
-    def __init__(self, path, mode, encoding=None):
+    def __init__(self, path, mode, encoding=None, **kwargs):
         if mode[0] != 'r':
             raise ArchiveIOError("Unsupported file mode '%s' for Handle7z" % mode)
         if encoding is None:
             encoding = sys.getfilesystemencoding()
-        cmd = self.filelist_cmd + (path, )
+        cmd = (self.executable, ) + self.filelist_args + (path, )
         output = run(cmd, capture_output=True, encoding=encoding,
                      creationflags=CREATE_NO_WINDOW)
         if output.stderr:
@@ -44,30 +281,96 @@ class Handle7z(object):
             if m is not None:
                 cfn = row[m.end():].strip()
                 filelist.append(self.FileType(cfn))
-        self.path = path
-        self._filelist = filelist
+        super().__init__(path, filelist, **kwargs)
         self.encoding = encoding
 
-    def read(self, fileinfo):
-        cmd = self.fileread_cmd + (self.path, fileinfo.filename)
-        output = run(cmd, capture_output=True, creationflags=CREATE_NO_WINDOW)
+    def _extract_members(self, names):
+        fd, listfile = tempfile.mkstemp(suffix='.txt', dir=self._tmpdir)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as fout:
+                fout.write('\n'.join(names))
+            cmd = (self.executable, ) + self.extract_args + \
+                  ('-o' + self._tmpdir, '--', self.path, '@' + listfile)
+            output = run(cmd, capture_output=True,
+                         creationflags=CREATE_NO_WINDOW)
+        finally:
+            os.remove(listfile)
         err = output.stderr.decode(self.encoding)
         if err:
             raise ArchiveIOError(err)
-        return output.stdout
+
+
+class HandlePy7zr(BatchHandle):
+    """
+    Reads 7z archives in process with py7zr.
+    """
+    formats = {'.7z', '.cb7'}
+
+    def __init__(self, path, mode, **kwargs):
+        if mode[0] != 'r':
+            raise ArchiveIOError("Unsupported file mode '%s' for HandlePy7zr" % mode)
+        try:
+            self._archive = py7zr.SevenZipFile(path, 'r')
+            infos = self._archive.list()
+        except Exception as err:
+            raise ArchiveIOError(text_type(err))
+        filelist = [self.FileType(fi.filename) for fi in infos
+                    if not fi.is_directory]
+        super().__init__(path, filelist, **kwargs)
+
+    def _extract_members(self, names):
+        try:
+            self._archive.extract(path=self._tmpdir, targets=names)
+        except Exception as err:
+            raise ArchiveIOError(text_type(err))
+        finally:
+            self._archive.reset()
 
     def close(self):
-        pass
+        super().close()
+        self._archive.close()
 
-    @property
-    def filelist(self):
-        return list(self._filelist)
 
-KNOWN_ARCHIVES.update(Handle7z.formats)
+class HandleRar(BatchHandle):
+    """
+    Reads rar archives with rarfile.
+    """
+    formats = {'.rar', '.cbr'}
 
+    def __init__(self, path, mode, **kwargs):
+        if mode[0] != 'r':
+            raise ArchiveIOError("Unsupported file mode '%s' for HandleRar" % mode)
+        try:
+            self._archive = rarfile.RarFile(path, 'r')
+            infos = self._archive.infolist()
+        except (rarfile.Error, OSError) as err:
+            raise ArchiveIOError(text_type(err))
+        filelist = [self.FileType(ri.filename) for ri in infos
+                    if not ri.is_dir()]
+        super().__init__(path, filelist, **kwargs)
 
-class ArchiveIOError(WrapperIOError):
-    pass
+    def _extract_members(self, names):
+        try:
+            self._archive.extractall(self._tmpdir, names)
+        except (rarfile.Error, OSError) as err:
+            raise ArchiveIOError(text_type(err))
+
+    def close(self):
+        super().close()
+        self._archive.close()
+
+
+register_handler(open_zip, {'.zip', '.cbz'},
+                 [(0, b'PK\x03\x04'), (0, b'PK\x05\x06')])
+register_handler(HandleTar, HandleTar.formats, [(257, b'ustar')])
+if py7zr is not None:
+    register_handler(HandlePy7zr, HandlePy7zr.formats,
+                     [(0, b'7z\xbc\xaf\x27\x1c')])
+if rarfile is not None:
+    register_handler(HandleRar, HandleRar.formats, [(0, b'Rar!\x1a\x07')])
+if Handle7z.executable is not None:
+    register_handler(Handle7z, Handle7z.formats,
+                     [(0, b'7z\xbc\xaf\x27\x1c'), (0, b'Rar!\x1a\x07')])
 
 
 class ArchiveIO(BytesIO):
@@ -90,51 +393,211 @@ class ArchiveIO(BytesIO):
     def close(self):
         if self._opened and self._mode[0] in {'a','w'} and self._parent.handle:
             self._parent.handle.writestr(self._fileinfo,self.getvalue())
+            self._parent.reset_index()
         self._opened = False
         super().close()
 
 
+class MemoryIO(RawIOBase):
+    """
+    A read only and seekable stream over a memoryview, e.g. a stored member
+    of a memory mapped archive. Only the requested parts are copied when
+    reading.
+    """
+    def __init__(self, view):
+        super().__init__()
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            pos = offset
+        elif whence == 1:
+            pos = self._pos + offset
+        elif whence == 2:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError('invalid whence (%r)' % whence)
+        if pos < 0:
+            raise ValueError('negative seek position %d' % pos)
+        self._pos = pos
+        return pos
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        end = len(self._view)
+        if size is not None and size >= 0:
+            end = min(self._pos + size, end)
+        data = self._view[self._pos:end].tobytes()
+        self._pos += len(data)
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def getvalue(self):
+        return self._view.tobytes()
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
 class ArchiveWrapper(BaseWrapper):
+    # signature and layout of the local file header of a zip member
+    zip_header = struct.Struct('<IHHHHHIIIHH')
+    zip_header_sig = 0x04034b50
+
     def __init__(self, path, mode='r'):
         self.path = path
         self.mode = mode
-        name, ext = os.path.splitext(path)
+        self._mmap = None
+        self._mmap_lock = threading.Lock()
+        self._entries = None
+        self._names = None
+        self._filtered = {}
         if os.path.isdir(path):
             self.handle = None
-        elif ext.lower() in {'.zip','.cbz'}:
-            try:
-                self.handle = zipfile.ZipFile(path,mode)
-            except zipfile.BadZipfile as err:
-                raise ArchiveIOError(text_type(err))
-        elif ext.lower() in self.formats:
-            self.handle = Handle7z(path,mode)
         else:
-            raise ArchiveIOError('"%s" is not a supported archive' % path)
+            factory = find_handler(path, mode)
+            if factory is None:
+                raise ArchiveIOError('"%s" is not a supported archive' % path)
+            self.handle = factory(path, mode)
 
     @property
     def filelist(self):
-        if self.handle is None and self.path:
-            filelist = self.folderlist(self.path)
-        elif isinstance(self.handle, (zipfile.ZipFile, Handle7z)):
-            filelist = self.handle.filelist
-        else:
-            filelist = []
+        return list(self._index())
+
+    def filter_file_extension(self, exts):
+        exts = frozenset(exts)
+        filtered = self._filtered.get(exts)
+        if filtered is None:
+            filtered = super().filter_file_extension(exts)
+            self._filtered[exts] = filtered
+        return list(filtered)
+
+    def reset_index(self):
+        """
+        Drop the cached list of members, e.g. after a member was written.
+        """
+        self._entries = None
+        self._names = None
+        self._filtered = {}
 
-        return sorted(filelist,key=ArchiveWrapper.split_filename)
+    def _index(self):
+        """
+        Return the members sorted by their natural order. The list and a map
+        from filename to member are only build once after opening.
+        """
+        entries = self._entries
+        if entries is None:
+            if self.handle is None and self.path:
+                filelist = self.folderlist(self.path)
+            elif self.handle is not None:
+                filelist = self.handle.filelist
+            else:
+                filelist = []
+            entries = sorted(filelist,key=ArchiveWrapper.split_filename)
+            self._names = {fi.filename: fi for fi in entries}
+            self._entries = entries
+        return entries
+
+    def __contains__(self, filename):
+        self._index()
+        return filename in self._names
 
     def open(self,fileinfo,mode):
         if mode in {'a','w'} and self.mode[0] == 'r':
             raise ArchiveIOError('Child mode does not fit to mode of Archive')
 
-        if self.handle:
+        if mode[0] == 'r' and self.mode[0] == 'r' and \
+          isinstance(self.handle, zipfile.ZipFile):
+            return self._open_member(fileinfo)
+        elif self.handle:
             return ArchiveIO(fileinfo,mode,self)
         else:
             fullpath = os.path.join(self.path,fileinfo.filename)
-            return open(fullpath,mode)
+            fout = open(fullpath,mode)
+            if mode[0] in {'a','w'}:
+                self.reset_index()
+            return fout
+
+    def set_prefetch(self, count):
+        """
+        Set the number of members which are extracted ahead of the
+        requested one, if the archive is extracted in batches.
+        """
+        if isinstance(self.handle, BatchHandle):
+            self.handle.prefetch = count
 
     def close(self):
         self.path = None
         self.mode = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # still used by an open member, closed once it is released
+                pass
+            self._mmap = None
         if self.handle is not None:
             self.handle.close()
 
+    def _open_member(self, fileinfo):
+        """
+        Return a seekable stream over the zip member without reading it
+        completely. Stored members are served from a memory map of the
+        archive, compressed ones are decompressed while reading.
+        """
+        try:
+            if not isinstance(fileinfo, zipfile.ZipInfo):
+                fileinfo = self.handle.getinfo(fileinfo.filename)
+            if fileinfo.compress_type == zipfile.ZIP_STORED and \
+              not fileinfo.flag_bits & 0x1:
+                view = self._stored_member(fileinfo)
+                if view is not None:
+                    return MemoryIO(view)
+            return self.handle.open(fileinfo)
+        except (zipfile.BadZipfile, KeyError) as err:
+            raise ArchiveIOError(text_type(err))
+
+    def _stored_member(self, fileinfo):
+        """
+        Return a memoryview of the data of a stored member or None if the
+        archive can not be mapped.
+        """
+        with self._mmap_lock:
+            if self._mmap is None:
+                try:
+                    with open(self.path, 'rb') as fin:
+                        self._mmap = mmap.mmap(fin.fileno(), 0,
+                                               access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    return None
+        mm = self._mmap
+
+        offset = fileinfo.header_offset
+        if offset + self.zip_header.size > len(mm):
+            return None
+        header = self.zip_header.unpack_from(mm, offset)
+        if header[0] != self.zip_header_sig:
+            return None
+        start = offset + self.zip_header.size + header[9] + header[10]
+        end = start + fileinfo.file_size
+        if end > len(mm):
+            return None
+        return memoryview(mm)[start:end]
+
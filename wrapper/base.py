@@ -19,6 +19,10 @@ Created on Sat Nov 11 18:50:02 2017
 
 import os
 import re
+import tempfile
+import threading
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 #import htmllib,formatter
 from six import text_type, next
 #from six.moves import cStringIO as StringIO
@@ -47,19 +51,222 @@ def pull(*args):
         niters = []
         
         
+@contextmanager
+def atomic_write(path, mode='wb'):
+    """
+    Open a temporary file next to path for writing. It replaces path once
+    the block is left without an error, so a partially written file is
+    never exposed.
+    """
+    fd, tmppath = tempfile.mkstemp(suffix='.tmp',
+                                   dir=os.path.dirname(path) or os.curdir)
+    try:
+        with os.fdopen(fd, mode) as fout:
+            yield fout
+        os.replace(tmppath, path)
+    except Exception:
+        os.remove(tmppath)
+        raise
+
+
+def has_format(path, formats):
+    """
+    Return whether the path ends with one of the file extensions in
+    formats, which may consist of several parts like ``.tar.gz``.
+    """
+    lpath = path.lower()
+    return any(lpath.endswith(ext) for ext in formats)
+
+
 class ArchiveIOError(IOError):
     pass
 
+
+DirSnapshot = namedtuple('DirSnapshot', ('mtime', 'files', 'dirs'))
+
+
+class FolderIndex(object):
+    """
+    Caches the naturally sorted files and subfolders of directories.
+
+    The directory is listed with os.scandir, which needs no extra stat call
+    per entry. A snapshot is reused as long as the modification time of the
+    directory is unchanged, so repeated listings only cost a single stat.
+    """
+    def __init__(self):
+        self._snapshots = {}
+        self._scanning = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self, path):
+        """
+        Return the DirSnapshot of the directory at path. The lists are empty
+        if the directory can not be read.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            scanning = self._scanning.get(path)
+        if scanning is not None:
+            scanning.wait()
+        return self._update(path)
+
+    def scan(self, path):
+        """
+        Update the snapshot of the directory at path in a background thread.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            if path in self._scanning:
+                return
+            self._scanning[path] = threading.Event()
+        thread = threading.Thread(target=self._scan, args=(path, ),
+                                  daemon=True)
+        thread.start()
+
+    def _scan(self, path):
+        try:
+            self._update(path)
+        finally:
+            with self._lock:
+                self._scanning.pop(path).set()
+
+    def _update(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except (OSError, ValueError):
+            return DirSnapshot(None, [], [])
+        with self._lock:
+            snapshot = self._snapshots.get(path)
+        if snapshot is not None and snapshot.mtime == mtime:
+            return snapshot
+
+        files, dirs = [], []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file():
+                            files.append(entry.name)
+                        elif entry.is_dir():
+                            dirs.append(entry.name)
+                    except OSError:
+                        pass
+        except OSError:
+            return DirSnapshot(None, [], [])
+
+        key = BaseWrapper.split_filename
+        snapshot = DirSnapshot(mtime, sorted(files,key=key),
+                               sorted(dirs,key=key))
+        with self._lock:
+            self._snapshots[path] = snapshot
+        return snapshot
+
+
+FOLDER_INDEX = FolderIndex()
+
+
+class CacheIndex(object):
+    """
+    Tracks the size and the last use of the entries of a cache folder and
+    removes the least recently used ones once they need more than
+    ``maxbytes``.
+
+    The entries already in the folder are found in a background thread by
+    ``scan``, which is called with the folder and yields the modification
+    time, the key and the size of every entry. ``remove`` is called with
+    the key of an entry to delete it.
+    """
+    def __init__(self, scan, remove, maxbytes):
+        self.scan = scan
+        self.remove = remove
+        self.maxbytes = maxbytes
+        self.folder = ''
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def set_folder(self, folder):
+        with self._lock:
+            if folder == self.folder:
+                return
+            self.folder = folder
+            self._entries.clear()
+            self._nbytes = 0
+        if folder:
+            thread = threading.Thread(target=self._scan, args=(folder, ),
+                                      daemon=True)
+            thread.start()
+
+    def touch(self, key):
+        """
+        Mark the entry as the most recently used one.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def add(self, key, nbytes):
+        """
+        Add or update the entry and remove the least recently used ones if
+        the cache got too large.
+        """
+        with self._lock:
+            self._nbytes -= self._entries.pop(key, 0)
+            self._entries[key] = nbytes
+            self._nbytes += nbytes
+            dropped = self._shrink()
+        for key in dropped:
+            self.remove(key)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def _scan(self, folder):
+        found = sorted(self.scan(folder), reverse=True)
+        with self._lock:
+            if folder != self.folder:
+                return
+            # entries added during the scan are the most recently used ones
+            for mtime, key, nbytes in found:
+                if key not in self._entries:
+                    self._entries[key] = nbytes
+                    self._entries.move_to_end(key, last=False)
+                    self._nbytes += nbytes
+            dropped = self._shrink()
+        for key in dropped:
+            self.remove(key)
+
+    def _shrink(self):
+        dropped = []
+        while self._nbytes > self.maxbytes and self._entries:
+            key, nbytes = self._entries.popitem(last=False)
+            self._nbytes -= nbytes
+            dropped.append(key)
+        return dropped
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class BaseFileInfo(object):
     def __init__(self, filename):
         self.filename = filename
 
 class BaseWrapper(object):
     formats = KNOWN_ARCHIVES
+    re_number = re.compile(r'\d+')
     
     @property
     def filelist(self):
         raise NotImplementedError()
+
+    @property
+    def scanning(self):
+        """
+        Whether the filelist is still extended in the background.
+        """
+        return False
     
     def open(self, fileinfo, mode):
         raise NotImplementedError()
@@ -92,46 +299,35 @@ class BaseWrapper(object):
 
     def list_archives(self):
         folder, name = os.path.split(self.path)
-        archlist = []
-        index = 0
+        snapshot = FOLDER_INDEX.snapshot(folder or os.curdir)
         if os.path.isdir(self.path):
-            dirlist = os.listdir(folder)
-            dirlist = sorted(dirlist,key=self.split_filename)
-            for f in dirlist:
-                fullpath = os.path.join(folder,f)
-                if os.path.isdir(fullpath):
-                    if f == name:
-                        index = len(archlist)
-                    archlist.append(fullpath)
+            names = snapshot.dirs
         else:
-            filelist = self.folderlist(folder,'',False)
-            filelist = sorted(filelist,key=self.split_filename)
-            for zi in filelist:
-                base, ext = os.path.splitext(zi.filename)
-                if ext.lower() in self.formats:
-                    if zi.filename == name:
-                        index = len(archlist)
-                    fullpath = os.path.join(folder,zi.filename)
-                    archlist.append(fullpath)
-                
+            names = [f for f in snapshot.files
+                     if has_format(f, self.formats)]
+        archlist = [os.path.join(folder,f) for f in names]
+        index = names.index(name) if name in names else 0
+
         return archlist,index
-    
+
+    def scan_archives(self):
+        """
+        Index the folder containing this archive in the background, so a
+        later call of list_archives does not have to list it.
+        """
+        folder, name = os.path.split(self.path)
+        FOLDER_INDEX.scan(folder or os.curdir)
+
     @classmethod
     def folderlist(cls, path,base='',recursive=True):
-        filelist = []
-        try:
-            dirlist = os.listdir(path)
-        except:
-            dirlist = []
-            
-        for f in dirlist:
-            fullpath = os.path.join(path,f)
-            filename = os.path.join(base,f)
-            if os.path.isfile(fullpath):
-                filelist.append(BaseFileInfo(filename))
-            elif os.path.isdir(fullpath) and recursive:
-                filelist.extend(cls.folderlist(fullpath,filename))
-                
+        snapshot = FOLDER_INDEX.snapshot(path)
+        filelist = [BaseFileInfo(os.path.join(base,f))
+                    for f in snapshot.files]
+        if recursive:
+            for f in snapshot.dirs:
+                filelist.extend(cls.folderlist(os.path.join(path,f),
+                                               os.path.join(base,f)))
+
         return filelist
 
     @staticmethod        
@@ -140,7 +336,7 @@ class BaseWrapper(object):
         splits the given filename into a tuple of strings and number to allow
         for a simple alphanumber sorting.
         """
-        isnumber = re.compile(r'\d+')
+        isnumber = BaseWrapper.re_number
         if hasattr(fileinfo,'filename'):
             filename = fileinfo.filename
         else:
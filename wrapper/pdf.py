@@ -5,9 +5,14 @@ Created on Sat Nov 11 18:55:52 2017
 @author: Caasar
 """
 
-from ctypes import cdll,c_char_p
+import math
+import json
+import threading
+from ctypes import cdll,c_char_p,create_string_buffer
+from ctypes import Structure,byref,string_at,c_void_p,c_int,c_float
 from io import BytesIO
 from six import text_type
+import PIL.Image as Image
 from .base import WrapperIOError, BaseWrapper, KNOWN_ARCHIVES
 
 try:
@@ -19,6 +24,35 @@ except:
 class PdfIOError(WrapperIOError):
     pass
 
+class FzRect(Structure):
+    _fields_ = [('x0', c_float), ('y0', c_float),
+                ('x1', c_float), ('y1', c_float)]
+
+class FzIRect(Structure):
+    _fields_ = [('x0', c_int), ('y0', c_int), ('x1', c_int), ('y1', c_int)]
+
+class FzMatrix(Structure):
+    _fields_ = [('a', c_float), ('b', c_float), ('c', c_float),
+                ('d', c_float), ('e', c_float), ('f', c_float)]
+
+# prototypes of the functions needed to rasterize pages
+RENDER_API = {
+    'pdf_count_pages': (c_int, [c_void_p]),
+    'pdf_load_page': (c_void_p, [c_void_p, c_int]),
+    'pdf_bound_page': (c_void_p, [c_void_p, c_void_p, c_void_p]),
+    'pdf_free_page': (None, [c_void_p, c_void_p]),
+    'pdf_run_page': (None, [c_void_p, c_void_p, c_void_p, c_void_p,
+                            c_void_p]),
+    'fz_find_device_colorspace': (c_void_p, [c_void_p, c_char_p]),
+    'fz_new_pixmap_with_bbox': (c_void_p, [c_void_p, c_void_p, c_void_p]),
+    'fz_clear_pixmap_with_value': (None, [c_void_p, c_void_p, c_int]),
+    'fz_new_draw_device': (c_void_p, [c_void_p, c_void_p]),
+    'fz_free_device': (None, [c_void_p]),
+    'fz_pixmap_samples': (c_void_p, [c_void_p, c_void_p]),
+    'fz_pixmap_components': (c_int, [c_void_p, c_void_p]),
+    'fz_drop_pixmap': (None, [c_void_p, c_void_p]),
+}
+
 class PdfImage(object):
     def __init__(self, objid):
         self.objid = objid
@@ -27,13 +61,44 @@ class PdfImage(object):
     def __hash__(self):
         return hash(self.objid)
 
+class PdfPage(object):
+    def __init__(self, pageno):
+        self.pageno = pageno
+        self.filename = f'page{pageno + 1:04d}'
+
+    def __hash__(self):
+        return hash(self.pageno)
+
 class PdfWrapper(BaseWrapper):
+    """
+    Reads the embedded images of a PDF file with MuPDF.
+
+    The objects are scanned for images from the last to the first one, as
+    the images of the first pages are usually stored last. The scan stops at
+    the first image and continues in a background thread, while ``filelist``
+    grows with every found image. The found images are stored in
+    ``index_store`` if set, so opening the document again skips the scan.
+    The store is the disk cache of the viewer, so the indices count against
+    its size limit.
+
+    If ``render_pages`` is set, the pages are rasterized by ``render``
+    instead, which also shows vector and text pages.
+    """
+    # stores the image indices, see DiskCache.get_file and put_file
+    index_store = None
+    render_pages = False
+    # resolution defining the original size of rendered pages
+    render_dpi = 150
+
     def __init__(self, path, minsize=5120, bufferlen=1048576):
         self.path = path
         self.minsize = minsize
         self.dll = LIBMUPDF
         self.dll.pdf_to_name.restype = c_char_p
         self.bufferlen = bufferlen
+        # the context is not thread safe, so all reads share one buffer
+        self._buffer = create_string_buffer(bufferlen)
+        self._lock = threading.Lock()
         try:
             self.context = self.dll.fz_new_context(None, None, 0)
         except:
@@ -52,42 +117,202 @@ class PdfWrapper(BaseWrapper):
         if not self.doc:
             raise PdfIOError('Could not open "%s"' % path)
             
+        self._filelist = []
+        self._closing = False
+        self._scanner = None
+        self.render_pages = self.render_pages and self._declare_render_api()
+        if self.render_pages:
+            cnt_pages = self.dll.pdf_count_pages(c_void_p(self.doc))
+            self._filelist.extend(PdfPage(cur) for cur in range(cnt_pages))
+            return
+
+        objids = self._load_index()
+        if objids is not None:
+            self._filelist.extend(PdfImage(objid) for objid in objids)
+            return
+
         cnt_obj = self.dll.pdf_count_objects(self.doc)
-        filelist = []
-        for cur in range(cnt_obj):
-            obj = self.dll.pdf_load_object(self.doc, cur, 0)
-            if self._isimage(obj):
-                filelist.append(PdfImage(cur))
-            self.dll.pdf_drop_obj(obj)
-                
-        self._filelist = filelist[::-1]
-        
+        remaining = iter(range(cnt_obj-1, -1, -1))
+        for cur in remaining:
+            if self._scan_object(cur):
+                break
+        self._scanner = threading.Thread(target=self._scan,
+                                         args=(remaining, ), daemon=True)
+        self._scanner.start()
+
     @property
     def filelist(self):
         return self._filelist
+
+    @property
+    def scanning(self):
+        return self._scanner is not None and self._scanner.is_alive()
         
     def filter_images(self):
         return self.filelist
 
     def close(self):
+        self._closing = True
+        if self._scanner is not None:
+            self._scanner.join()
+            self._scanner = None
         self.dll.pdf_close_document(self.doc)
         self.dll.fz_free_context(self.context)
         
     def open(self,fileinfo,mode):
         if mode in {'a','w'} and self.mode[0] == 'r':
             raise PdfIOError('Child mode does not fit to mode of Archive')
+        if isinstance(fileinfo, PdfPage):
+            raise PdfIOError('Rendered pages have to be loaded with render')
         
-        raw = ''
-        stream = self.dll.pdf_open_raw_stream(self.doc,fileinfo.objid,0)
-        buf = ' ' * self.bufferlen
-        read = self.dll.fz_read(stream,buf,self.bufferlen)
-        while read:
-            raw += buf[:read]
-            buf = ' ' * self.bufferlen
-            read = self.dll.fz_read(stream,buf,self.bufferlen)
+        raw = bytearray()
+        with self._lock:
+            stream = self.dll.pdf_open_raw_stream(self.doc,fileinfo.objid,0)
+            if not stream:
+                raise PdfIOError('Could not open object %d' % fileinfo.objid)
+            view = memoryview(self._buffer)
+            try:
+                read = self.dll.fz_read(stream,self._buffer,self.bufferlen)
+                while read > 0:
+                    raw += view[:read]
+                    read = self.dll.fz_read(stream,self._buffer,self.bufferlen)
+            finally:
+                view.release()
+                self.dll.fz_close(stream)
 
+        if read < 0:
+            raise PdfIOError('Could not read object %d' % fileinfo.objid)
         return BytesIO(raw)
 
+    def render(self, fileinfo, target_size):
+        """
+        Rasterize the page directly at its target size.
+
+        Parameters
+        ----------
+        fileinfo : PdfPage
+            The page to render.
+        target_size : callable
+            Called with the size of the page at ``render_dpi`` and returns
+            the size of the rendered image.
+
+        Returns
+        -------
+        img : PIL.Image
+            The rendered RGB image.
+        origsize : tuple
+            The size of the page at ``render_dpi``.
+        """
+        dll = self.dll
+        ctx = c_void_p(self.context)
+        doc = c_void_p(self.doc)
+        with self._lock:
+            page = dll.pdf_load_page(doc, fileinfo.pageno)
+            if not page:
+                raise PdfIOError('Could not load page %d' % (fileinfo.pageno+1))
+            try:
+                bounds = FzRect()
+                dll.pdf_bound_page(doc, page, byref(bounds))
+                width = bounds.x1 - bounds.x0
+                height = bounds.y1 - bounds.y0
+                if width <= 0 or height <= 0:
+                    raise PdfIOError('Page %d is empty' % (fileinfo.pageno+1))
+                scale = self.render_dpi / 72.
+                origsize = (max(1, int(round(width*scale))),
+                            max(1, int(round(height*scale))))
+                csize = tuple(target_size(origsize))
+                sx, sy = csize[0]/width, csize[1]/height
+                ctm = FzMatrix(sx, 0, 0, sy, 0, 0)
+                x0 = int(math.floor(bounds.x0*sx))
+                y0 = int(math.floor(bounds.y0*sy))
+                bbox = FzIRect(x0, y0, x0+csize[0], y0+csize[1])
+
+                rgb = dll.fz_find_device_colorspace(ctx, b'DeviceRGB')
+                pix = dll.fz_new_pixmap_with_bbox(ctx, rgb, byref(bbox))
+                if not pix:
+                    raise PdfIOError('Could not render page %d' %
+                                     (fileinfo.pageno+1))
+                try:
+                    dll.fz_clear_pixmap_with_value(ctx, pix, 255)
+                    dev = dll.fz_new_draw_device(ctx, pix)
+                    try:
+                        dll.pdf_run_page(doc, page, dev, byref(ctm), None)
+                    finally:
+                        dll.fz_free_device(dev)
+                    ncomp = dll.fz_pixmap_components(ctx, pix)
+                    samples = dll.fz_pixmap_samples(ctx, pix)
+                    data = string_at(samples, csize[0]*csize[1]*ncomp)
+                finally:
+                    dll.fz_drop_pixmap(ctx, pix)
+            finally:
+                dll.pdf_free_page(doc, page)
+
+        # the samples of MuPDF pixmaps contain an alpha channel
+        mode = 'RGBA' if ncomp == 4 else 'RGB'
+        img = Image.frombuffer(mode, csize, data, 'raw', mode, 0, 1)
+        return img.convert('RGB'), origsize
+
+    def _declare_render_api(self):
+        """
+        Declare the prototypes needed by render and return whether the
+        library provides them.
+        """
+        try:
+            for name, (restype, argtypes) in RENDER_API.items():
+                func = getattr(self.dll, name)
+                func.restype = restype
+                func.argtypes = argtypes
+        except AttributeError:
+            return False
+        return True
+
+    def _scan_object(self, objid):
+        """
+        Append the object to the filelist if it is an image and return
+        whether it was one.
+        """
+        with self._lock:
+            obj = self.dll.pdf_load_object(self.doc, objid, 0)
+            isimage = self._isimage(obj)
+            self.dll.pdf_drop_obj(obj)
+        if isimage:
+            self._filelist.append(PdfImage(objid))
+        return isimage
+
+    def _scan(self, remaining):
+        for cur in remaining:
+            if self._closing:
+                return
+            self._scan_object(cur)
+        self._store_index([fi.objid for fi in self._filelist])
+
+    def _index_name(self):
+        return f'pdfindex_{self.minsize}'
+
+    def _load_index(self):
+        """
+        Return the object ids of the images stored by an earlier scan or
+        None.
+        """
+        if self.index_store is None:
+            return None
+        content = self.index_store.get_file(self.path, self._index_name())
+        if content is None:
+            return None
+        try:
+            objids = json.loads(content.decode('utf-8'))
+        except ValueError:
+            return None
+        if not isinstance(objids, list) or \
+          not all(isinstance(objid, int) for objid in objids):
+            return None
+        return objids
+
+    def _store_index(self, objids):
+        if self.index_store is not None:
+            content = json.dumps(objids).encode('utf-8')
+            self.index_store.put_file(self.path, self._index_name(), content)
+
     def _isimage(self,obj):
         t = self.dll.pdf_dict_gets(obj, b"Subtype")
         if self.dll.pdf_is_name(t) and self.dll.pdf_to_name(t)== b"Image":
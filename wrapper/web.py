@@ -8,13 +8,25 @@ Created on Sat Nov 11 18:56:09 2017
 import sys
 import os
 import re
+import threading
+import asyncio
+import atexit
+import time
+import json
+import hashlib
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
 from io import BytesIO
 from pathlib import Path
 from six.moves.html_parser import HTMLParser
 from six.moves.urllib.parse import urlparse, ParseResult
-from .base import WrapperIOError, BaseWrapper
+from .base import WrapperIOError, BaseWrapper, CacheIndex, atomic_write
 import PIL.Image as Image
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
 
 try:
     from bs4 import BeautifulSoup
@@ -22,10 +34,424 @@ try:
 except ImportError:
     pass
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 class WebIOError(WrapperIOError):
     pass
 
 
+class WebSession(object):
+    """
+    A requests session shared by all web wrappers and their worker threads.
+
+    Connections are kept alive in a pool per host. At most ``max_per_host``
+    requests run against the same host at once, failed requests are retried
+    with an exponential backoff and every request has a timeout.
+    """
+    timeout = (10, 30)
+    max_per_host = 4
+    retries = 3
+    backoff = 0.5
+
+    def __init__(self):
+        self.session = requests.Session()
+        retry = Retry(total=self.retries, backoff_factor=self.backoff,
+                      status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=16,
+                              pool_maxsize=self.max_per_host,
+                              max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._probes = ThreadPoolExecutor(8)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with self._host_slot(url):
+            return self.session.request(method, url, **kwargs)
+
+    def probe(self, url):
+        """
+        Return a future of the content length of url, which is None if the
+        request failed.
+        """
+        return self._probes.submit(self._content_length, url)
+
+    def _content_length(self, url):
+        try:
+            with self.head(url) as resp:
+                return int(resp.headers.get("content-length",0))
+        except Exception:
+            return None
+
+    @contextmanager
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            slots = self._hosts.get(host)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.max_per_host)
+                self._hosts[host] = slots
+        with slots:
+            yield
+
+
+class WebResponse(object):
+    """
+    The parts of a requests.Response used by the wrappers, as returned by
+    the AsyncEngine.
+    """
+    def __init__(self, url, status_code, reason, headers, content, encoding):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise WebIOError(f'{self.status_code} {self.reason} '
+                             f'for url: {self.url}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+class AsyncEngine(object):
+    """
+    Runs the web requests of all wrappers on one asyncio event loop in a
+    dedicated thread using aiohttp.
+
+    Page and image downloads and the probes of the ImageParser are
+    multiplexed over the connections of a single client session, which
+    allows at most ``max_per_host`` connections per host. The blocking
+    methods wait for the result on the loop, so the engine can be used
+    like a WebSession.
+    """
+    timeout = WebSession.timeout
+    max_per_host = WebSession.max_per_host
+    retries = WebSession.retries
+    backoff = WebSession.backoff
+    retry_status = {429, 500, 502, 503, 504}
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        daemon=True)
+        self._thread.start()
+        self.session = self._call(self._open_session())
+        atexit.register(self.close)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def request(self, method, url, headers=None, timeout=None,
+                allow_redirects=None, **kwargs):
+        if kwargs:
+            raise TypeError(f'Unsupported arguments: {", ".join(kwargs)}')
+        if allow_redirects is None:
+            allow_redirects = method != 'HEAD'
+        return self._call(self._request(method, url, headers, timeout,
+                                        allow_redirects))
+
+    def probe(self, url):
+        """
+        Return a future of the content length of url, which is None if the
+        request failed.
+        """
+        return asyncio.run_coroutine_threadsafe(self._content_length(url),
+                                                self.loop)
+
+    def close(self):
+        """
+        Close the client session and stop the thread of the event loop.
+        """
+        if self.loop.is_closed():
+            return
+        atexit.unregister(self.close)
+        self._call(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _open_session(self):
+        connector = aiohttp.TCPConnector(limit_per_host=self.max_per_host)
+        return aiohttp.ClientSession(connector=connector,
+                                     timeout=self._client_timeout())
+
+    def _client_timeout(self, timeout=None):
+        """
+        Convert a timeout given like for requests, either as one value or
+        as pair of connect and read timeout, to an aiohttp.ClientTimeout.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if isinstance(timeout, (tuple, list)):
+            connect, read = timeout
+        else:
+            connect = read = timeout
+        return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+    async def _request(self, method, url, headers=None, timeout=None,
+                       allow_redirects=True):
+        options = {'headers': headers, 'allow_redirects': allow_redirects}
+        if timeout is not None:
+            options['timeout'] = self._client_timeout(timeout)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2**(attempt - 1))
+            try:
+                async with self.session.request(method, url,
+                                                **options) as resp:
+                    if resp.status in self.retry_status and \
+                      attempt < self.retries:
+                        continue
+                    content = await resp.read()
+                    try:
+                        encoding = resp.get_encoding()
+                    except (RuntimeError, LookupError):
+                        encoding = None
+                    return WebResponse(str(resp.url), resp.status,
+                                       resp.reason, resp.headers, content,
+                                       encoding)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                if attempt == self.retries:
+                    raise WebIOError(f'{err!r} for url: {url}') from err
+
+    async def _content_length(self, url):
+        try:
+            resp = await self._request('HEAD', url, allow_redirects=False)
+            return int(resp.headers.get("content-length",0))
+        except (WebIOError, ValueError):
+            return None
+
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def get_session():
+    """
+    Return the session shared by all web requests, an AsyncEngine if
+    aiohttp is installed and a WebSession otherwise. It is created with the
+    first request, so no connections or threads exist until a web comic is
+    opened.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = WebSession() if aiohttp is None else AsyncEngine()
+        return _SESSION
+
+
+class HttpCache(object):
+    """
+    Caches the responses of GET requests on disk, keyed by their url.
+
+    Responses with an ETag or Last-Modified header are stored in the
+    subfolder ``.http`` of ``folder``. Stored responses are used without a
+    request while they are fresh according to their Cache-Control max-age
+    and are revalidated with a conditional request otherwise. If the
+    request fails, the stored response is used anyway. The least recently
+    used responses are removed once they need more than ``maxbytes``.
+
+    The content of a response can be kept by another store instead, which
+    has the methods ``get(*ref)`` and ``put(*ref, content)``. Then only the
+    validators and the reference are stored here.
+    """
+    maxbytes = 2**30
+    re_max_age = re.compile(r'max-age\s*=\s*(\d+)')
+
+    def __init__(self, folder=''):
+        self.folder = ''
+        self._index = CacheIndex(self._scan, self._remove, self.maxbytes)
+        self.set_folder(folder)
+
+    def set_folder(self, folder):
+        self.folder = os.path.join(folder, '.http') if folder and \
+                      os.path.isdir(folder) else ''
+        self._index.set_folder(self.folder)
+
+    def get(self, url, store=None, ref=None):
+        """
+        Return the response of a GET request of url, either from the network
+        or from the cache. If store is given, a new content is put into it
+        as ref.
+        """
+        meta = self._load_meta(url) if self.folder else None
+        headers = {}
+        if meta is not None:
+            if meta['expires'] > time.time():
+                cached = self._response(url, meta, store)
+                if cached is not None:
+                    return cached
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            resp = get_session().get(url, headers=headers)
+        except IOError:
+            cached = None
+            if meta is not None:
+                cached = self._response(url, meta, store)
+            if cached is None:
+                raise
+            return cached
+
+        if resp.status_code == 304 and meta is not None:
+            meta['expires'] = self._expires(resp.headers)
+            cached = self._response(url, meta, store)
+            if cached is not None:
+                self._store_meta(url, meta)
+                return cached
+            # the stored response is gone, request it again completely
+            resp = get_session().get(url)
+
+        if self.folder and resp.status_code == 200 and \
+          (resp.headers.get('etag') or resp.headers.get('last-modified')):
+            self._store(url, resp, store, ref)
+        return resp
+
+    def _key(self, url):
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def _expires(self, headers):
+        control = headers.get('cache-control', '')
+        match = self.re_max_age.search(control)
+        if match is None or 'no-cache' in control:
+            return 0
+        return time.time() + int(match.group(1))
+
+    def _load_meta(self, url):
+        path = self._key(url)
+        try:
+            with open(path + '.json', 'r') as fin:
+                meta = json.load(fin)
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get('url') == url else None
+
+    def _response(self, url, meta, store=None):
+        path = self._key(url)
+        ref = meta.get('ref')
+        try:
+            if ref is None:
+                with open(path + '.bin', 'rb') as fin:
+                    content = fin.read()
+            else:
+                content = store.get(*ref) if store is not None else None
+                if content is None:
+                    return None
+            # the modification time marks the last use
+            os.utime(path + '.json')
+        except OSError:
+            return None
+        self._index.touch(path)
+        headers = {'content-type': meta.get('content_type', '')}
+        return WebResponse(url, 200, 'OK', headers, content,
+                           meta.get('encoding'))
+
+    def _store(self, url, resp, store=None, ref=None):
+        path = self._key(url)
+        content = resp.content
+        meta = {'url': url, 'etag': resp.headers.get('etag', ''),
+                'last_modified': resp.headers.get('last-modified', ''),
+                'content_type': resp.headers.get('content-type', ''),
+                'encoding': resp.encoding,
+                'expires': self._expires(resp.headers),
+                'nbytes': len(content)}
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if store is None:
+                with atomic_write(path + '.bin') as fout:
+                    fout.write(content)
+            else:
+                meta['ref'] = list(ref)
+                store.put(*ref, content)
+                # drop the content of an older response
+                self._remove(path, ('.bin',))
+        except OSError:
+            return
+        self._store_meta(url, meta)
+        self._index.add(path, self._nbytes(path))
+
+    def _store_meta(self, url, meta):
+        path = self._key(url)
+        try:
+            with atomic_write(path + '.json', 'w') as fout:
+                json.dump(meta, fout)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _scan(folder):
+        """
+        Yield the modification time, the path without extension and the
+        size of all stored responses.
+        """
+        for root, dirs, files in os.walk(folder):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name[:-5])
+                try:
+                    mtime = os.stat(path + '.json').st_mtime
+                except OSError:
+                    continue
+                yield mtime, path, HttpCache._nbytes(path)
+
+    @staticmethod
+    def _nbytes(path):
+        """
+        Return the size of the files of the response stored at path.
+        """
+        nbytes = 0
+        for ext in ('.json', '.bin'):
+            try:
+                nbytes += os.stat(path + ext).st_size
+            except OSError:
+                pass
+        return nbytes
+
+    @staticmethod
+    def _remove(path, exts=('.json', '.bin')):
+        for ext in exts:
+            try:
+                os.remove(path + ext)
+            except OSError:
+                pass
+
+
+HTTP_CACHE = HttpCache()
+
+
 class WebImage(object):
     def __init__(self,alt_urls,page_url,next_page=''):
         self.image_url = alt_urls[0]
@@ -39,8 +465,23 @@ class WebImage(object):
 
 
 class ImageParser(HTMLParser):
+    """
+    Finds the main image of a page without a profile.
+
+    The candidates are grouped by priority and the content length of all of
+    them is requested concurrently. The largest image of the first group
+    containing one larger than ``minlength`` wins and the remaining requests
+    are cancelled. If the server does not report a length, the size is
+    estimated from the width, height and srcset attributes. Candidates of
+    unknown size are ranked by their width.
+    """
     filtered = {'.gif'}
     minlength = 50000
+    # estimated size of an image per pixel if only its dimension is known
+    bytes_per_pixel = .25
+    max_cached = 4096
+    _lengths = dict()
+    _lengths_lock = threading.Lock()
 
     def __init__(self, url, html=None):
         super().__init__()
@@ -94,26 +535,74 @@ class ImageParser(HTMLParser):
             filtered = ext.lower() in self.filtered
             unknown_ext = ext.lower() not in Image.EXTENSION
             priority = unknown_ext*4 + (not self.saved_link)*2 + filtered
-            self.imgs_lists[priority].append((src,self.saved_link))
+            urls, hint = self._size_hint(elements, src)
+            self.imgs_lists[priority].append((urls,self.saved_link,hint))
 
     def find_image(self):
-        image_url = None
-        maxsize = -1
-
-        for img_list in self.imgs_lists:
-            for c_url, c_next in img_list:
-                c_size = int(ImageParser.get_content_length(c_url))
-                if maxsize < c_size:
-                    image_url, next_page = c_url, c_next
-                    maxsize = c_size
+        image_urls = None
+        maxrank = (-1, 0)
 
-            if maxsize > self.minlength:
-                break
-
-        if image_url is None:
+        # probe all candidates at once, in the order they are needed
+        probes = [[(self._probe(urls[0]), urls, c_next, hint)
+                   for urls, c_next, hint in img_list]
+                  for img_list in self.imgs_lists]
+        try:
+            for img_list in probes:
+                for future, c_urls, c_next, (width, height) in img_list:
+                    c_size = int(future.result() or 0) or \
+                             int(width * height * self.bytes_per_pixel)
+                    if maxrank < (c_size, width):
+                        image_urls, next_page = c_urls, c_next
+                        maxrank = c_size, width
+
+                if maxrank[0] > self.minlength:
+                    break
+        finally:
+            for img_list in probes:
+                for future, c_urls, c_next, hint in img_list:
+                    future.cancel()
+
+        if image_urls is None:
             raise WebIOError('No Image found at "%s"' % self.page_url)
 
-        return WebImage([image_url.strip()],self.page_url,next_page)
+        return WebImage([url.strip() for url in image_urls],
+                        self.page_url,next_page)
+
+    def _size_hint(self, elements, src):
+        """
+        Return the urls of the image, the largest candidate of srcset first,
+        and the width and height given by its attributes, which are 0 if
+        they are unknown.
+        """
+        width = self._to_int(elements.get('width'))
+        height = self._to_int(elements.get('height'))
+        urls = [src]
+        best = 0
+        for candidate in (elements.get('srcset') or '').split(','):
+            parts = candidate.split()
+            if len(parts) != 2 or parts[1][-1:] not in {'w', 'x'}:
+                continue
+            try:
+                value = float(parts[1][:-1])
+            except ValueError:
+                continue
+            if parts[1][-1] == 'x':
+                value *= width
+            if value > best:
+                best = value
+                urls = [self._fullpath(parts[0]).geturl(), src]
+        if best > width:
+            # without the aspect ratio the height of the candidate is unknown
+            height = height * best / width if width else 0
+            width = best
+        return urls, (width, height)
+
+    @staticmethod
+    def _to_int(value):
+        try:
+            return int(str(value).strip().rstrip('px'))
+        except ValueError:
+            return 0
 
     def _fullpath(self,url):
         purl = urlparse(url)
@@ -127,19 +616,49 @@ class ImageParser(HTMLParser):
 
         return ParseResult(*furl)
 
-    @staticmethod
-    def get_content_length(url):
-        try:
-            with requests.head(url) as request:
-                length = int(request.headers.get("content-length",0))
-        except Exception:
-            length = 0
-        return length
+    @classmethod
+    def get_content_length(cls, url):
+        return cls._probe(url).result() or 0
+
+    @classmethod
+    def _probe(cls, url):
+        """
+        Return a future of the content length of url. Successful probes are
+        cached.
+        """
+        with cls._lengths_lock:
+            if url in cls._lengths:
+                future = Future()
+                future.set_result(cls._lengths[url])
+                return future
+        future = get_session().probe(url)
+        future.add_done_callback(partial(cls._store_length, url))
+        return future
+
+    @classmethod
+    def _store_length(cls, url, future):
+        if future.cancelled() or future.exception() is not None or \
+          future.result() is None:
+            return
+        with cls._lengths_lock:
+            if len(cls._lengths) >= cls.max_cached:
+                cls._lengths.clear()
+            cls._lengths[url] = future.result()
 
 
 class WebWrapper(BaseWrapper):
+    """
+    Reads the images of a web comic by following its next_page links.
+
+    A background thread follows the chain of next pages and extends the
+    filelist, so it stays ``lookahead`` images ahead of the last opened
+    image.
+    """
     profiles = dict()
     profile_keys = ['url', 'img', 'next']
+    lookahead = 6
+    # keeps the downloaded images, see HttpCache
+    image_store = None
 
     def __init__(self, url):
         self.path = url
@@ -167,6 +686,14 @@ class WebWrapper(BaseWrapper):
             self.filename = soup.title.text.strip().replace(' ', '_')
             self.filename = re.sub(r'[^\w\s-]', '', self.filename)
 
+        self._positions = {fi: pos for pos, fi in enumerate(self._filelist)}
+        self._visited = {url}
+        self._crawl_target = 1 + self.lookahead
+        self._crawl_cond = threading.Condition()
+        self._closed = False
+        self._crawler = threading.Thread(target=self._crawl, daemon=True)
+        self._crawler.start()
+
     @property
     def filelist(self):
         return self._filelist
@@ -175,27 +702,50 @@ class WebWrapper(BaseWrapper):
         return self.filelist
 
     def load_next(self):
+        """
+        Load the images of the page following the last known image and
+        return whether new images were found.
+        """
         lastinfo = self.filelist[-1]
-        if lastinfo.next_page:
-            try:
-                if self.sel_img:
-                    nextinfos = self._parse_url(lastinfo.next_page)
-                    self.filelist.extend(nextinfos)
-                else:
-                    nextinfo = ImageParser(lastinfo.next_page).find_image()
-                    self.filelist.append(nextinfo)
-            except WebIOError:
-                pass
+        next_page = lastinfo.next_page
+        if not next_page or next_page in self._visited:
+            return False
+        try:
+            if self.sel_img:
+                nextinfos = self._parse_url(next_page)
+            else:
+                nextinfos = [ImageParser(next_page).find_image()]
+        except WebIOError:
+            return False
+
+        with self._crawl_cond:
+            # another thread might have extended the list in the meantime
+            if self.filelist[-1] is not lastinfo:
+                return True
+            self._visited.add(next_page)
+            for info in nextinfos:
+                self._positions[info] = len(self.filelist)
+                self.filelist.append(info)
+            self._crawl_cond.notify_all()
+        return True
 
     def open(self,fileinfo,mode):
         if mode in {'a','w'} and self.mode[0] == 'r':
             raise WebIOError('Child mode does not fit to mode of Archive')
 
-        if fileinfo == self.filelist[-1]:
-            self.load_next()
+        pos = self._positions.get(fileinfo, 0)
+        with self._crawl_cond:
+            target = pos + 1 + self.lookahead
+            if target > self._crawl_target:
+                self._crawl_target = target
+                self._crawl_cond.notify_all()
 
+        # images are looked up by their url and stored only once, in the
+        # image store under the name of the comic
+        ref = self.filename, f'{pos + 1:03d}_{fileinfo.filename}'
         for curl in fileinfo.alt_urls:
-            with requests.get(curl) as resp:
+            store = self.image_store
+            with HTTP_CACHE.get(curl, store, ref) as resp:
                 resp.raise_for_status()
                 if resp.headers.get('content-type', '').startswith('image/'):
                     return BytesIO(resp.content)
@@ -204,11 +754,33 @@ class WebWrapper(BaseWrapper):
 
 
     def close(self):
-        pass
+        with self._crawl_cond:
+            self._closed = True
+            self._crawl_cond.notify_all()
 
     def list_archives(self):
         return [], 0
 
+    def scan_archives(self):
+        pass
+
+    def _crawl(self):
+        failed = None
+        while True:
+            with self._crawl_cond:
+                # after a failure wait until the reader moves on to retry
+                while not self._closed and \
+                  (len(self.filelist) >= self._crawl_target or
+                   self._crawl_target == failed):
+                    self._crawl_cond.wait()
+                if self._closed:
+                    return
+                next_page = self.filelist[-1].next_page
+                if not next_page or next_page in self._visited:
+                    return
+            if not self.load_next():
+                failed = self._crawl_target
+
     def _parse_url(self, url, soup=None):
         if soup is None:
             soup = BeautifulSoup(self.load_url(url), "html.parser")
@@ -274,7 +846,7 @@ class WebWrapper(BaseWrapper):
     @classmethod
     def load_url(cls, url):
         try:
-            with requests.get(url) as resp:
+            with HTTP_CACHE.get(url) as resp:
                 resp.raise_for_status()
                 html = resp.text
         except Exception as e: